@@ -0,0 +1,194 @@
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from CV2.cv import get_cv
+from CV2.cv2 import get_cv2
+from CV2.cv2 import get_pair_mean_bin_edges
+from CV2.utils.read_data import BINARY_SUFFIX, read_from_txt
+from CV2.utils.spike_train import SpikeTrain, as_spike_train
+
+
+def analyse_unit(spk_train,
+                 time_min: float = 0,
+                 time_max: float = 10000,
+                 max_pair_mean: float = 0.1,
+                 isi_pair_bin: float = 0.01,
+                 binary_cache: bool = False):
+    r"""
+    Calculate the cv, the mean cv2 and the cv2 of every ISI pair mean bin of one unit, without plotting.
+
+    Parameters
+    ----------
+    spk_train: list, SpikeTrain or str
+        The spike times for one single unit in seconds, or the file they are loaded from.
+    time_min, time_max, max_pair_mean, isi_pair_bin:
+        See get_cv2.
+    binary_cache: bool
+        If True, a text file is loaded with load_spike_train, which writes a '.spk' file next to it for later loads.
+        Otherwise it is only read, nothing is written into its directory.
+
+    Returns
+    -------
+    result: dict with the keys 'spike_count', 'cv', 'mean_cv2', 'mean_of_isi_bin_middle' and 'cv2_mean_of_bin'
+    """
+    if isinstance(spk_train, str):
+        if binary_cache or spk_train.endswith(BINARY_SUFFIX):
+            spk_train = SpikeTrain.from_file(spk_train)
+        else:
+            spk_train = SpikeTrain(read_from_txt(spk_train))
+    spk_train = as_spike_train(spk_train)
+    first, last = spk_train.index_range(time_min, time_max)
+    isis = spk_train.isis[first:max(first, min(last, len(spk_train) - 1))]
+
+    result = {'spike_count': len(spk_train)}
+    result['cv'] = get_cv(isis) if len(isis) > 1 else np.nan
+    if len(isis) > 1:
+        result_cv2 = get_cv2(spk_train, time_min, time_max, max_pair_mean, isi_pair_bin)
+        result['mean_cv2'] = result_cv2['mean_cv2']
+        result['mean_of_isi_bin_middle'] = np.asarray(result_cv2['mean_of_isi_bin_middle'])
+        result['cv2_mean_of_bin'] = np.asarray(result_cv2['cv2_mean_of_bin'])
+    else:
+        result['mean_cv2'] = np.nan
+        result['mean_of_isi_bin_middle'] = None
+        result['cv2_mean_of_bin'] = None
+    return result
+
+
+def batch_cv2(spike_trains,
+              unit_names: list = None,
+              time_min: float = 0,
+              time_max: float = 10000,
+              max_pair_mean: float = 0.1,
+              isi_pair_bin: float = 0.01,
+              binary_cache: bool = False,
+              processes: int = None):
+    r"""
+    Calculate the cv, the mean cv2 and the binned cv2 of many units in parallel across processes.
+
+    Parameters
+    ----------
+    spike_trains: dict or list
+        The spike trains of the units, {unit_name: spk_train} or a list of spike trains.
+        A spike train can also be given as the file it is loaded from, so that only the name is sent to the workers.
+    unit_names: list
+        The names of the units when spike_trains is a list. Defaults to their index.
+    time_min, time_max, max_pair_mean, isi_pair_bin:
+        See get_cv2.
+    binary_cache: bool
+        See analyse_unit.
+    processes: int
+        The number of worker processes. Defaults to the number of cores, 1 runs in the calling process.
+
+    Returns
+    -------
+    results: dict of arrays, one row per unit
+        'unit_name', 'spike_count', 'cv', 'mean_cv2', 'mean_of_isi_bin_middle' (bins,), 'cv2_mean_of_bin' (units, bins)
+    """
+    if isinstance(spike_trains, dict):
+        unit_names = list(spike_trains.keys())
+        spike_trains = list(spike_trains.values())
+    elif unit_names is None:
+        unit_names = [str(i) for i in range(len(spike_trains))]
+
+    analyse = partial(analyse_unit, time_min=time_min, time_max=time_max,
+                      max_pair_mean=max_pair_mean, isi_pair_bin=isi_pair_bin, binary_cache=binary_cache)
+    if processes == 1:
+        unit_results = list(map(analyse, spike_trains))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunksize = max(1, len(spike_trains) // (4 * (processes or os.cpu_count())))
+            unit_results = list(executor.map(analyse, spike_trains, chunksize=chunksize))
+
+    bin_edges = get_pair_mean_bin_edges(max_pair_mean, isi_pair_bin)
+    cv2_mean_of_bin = np.full((len(unit_results), len(bin_edges) - 1), np.nan)
+    for i, unit_result in enumerate(unit_results):
+        if unit_result['cv2_mean_of_bin'] is not None:
+            cv2_mean_of_bin[i] = unit_result['cv2_mean_of_bin']
+
+    results = {}
+    results['unit_name'] = np.asarray(unit_names, dtype=str)
+    results['spike_count'] = np.asarray([unit_result['spike_count'] for unit_result in unit_results])
+    results['cv'] = np.asarray([unit_result['cv'] for unit_result in unit_results], dtype=np.float64)
+    results['mean_cv2'] = np.asarray([unit_result['mean_cv2'] for unit_result in unit_results], dtype=np.float64)
+    results['mean_of_isi_bin_middle'] = bin_edges[:-1] + isi_pair_bin / 2
+    results['cv2_mean_of_bin'] = cv2_mean_of_bin
+    return results
+
+
+def batch_cv2_from_directory(directory: str,
+                             pattern: str = '*.txt',
+                             **kwargs):
+    r"""
+    Run batch_cv2 on every spike train file of a directory, the unit names are the file stems.
+
+    Parameters
+    ----------
+    directory: str
+        The directory containing one file of timestamps per unit.
+    pattern: str
+        The glob pattern of the spike train files.
+    kwargs:
+        See batch_cv2.
+    """
+    file_names = sorted(glob.glob(os.path.join(directory, pattern)))
+    unit_names = [os.path.splitext(os.path.basename(file_name))[0] for file_name in file_names]
+    return batch_cv2(file_names, unit_names, **kwargs)
+
+
+def save_batch_results(results: dict, file_name: str):
+    r"""
+    Write the results of batch_cv2 into one table, a '.npz' archive or a '.csv' file with one row per unit.
+    """
+    if file_name.endswith('.npz'):
+        np.savez(file_name, **results)
+        return
+
+    bin_names = [f'cv2_bin_{middle:g}' for middle in results['mean_of_isi_bin_middle']]
+    with open(file_name, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['unit_name', 'spike_count', 'cv', 'mean_cv2'] + bin_names)
+        for i in range(len(results['unit_name'])):
+            writer.writerow([results['unit_name'][i], results['spike_count'][i], results['cv'][i],
+                             results['mean_cv2'][i]] + list(results['cv2_mean_of_bin'][i]))
+
+
+def draw_batch_results(results: dict):
+    r"""
+    Draw the binned cv2 of every unit versus Mean of ISI Pair.
+    """
+    import matplotlib.pyplot as plt
+
+    for cv2_mean_of_bin in results['cv2_mean_of_bin']:
+        plt.plot(results['mean_of_isi_bin_middle'], cv2_mean_of_bin, linewidth=0.5)
+    plt.xlabel('Mean of ISI Pair')
+    plt.ylabel('CV2')
+    plt.show()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calculate the cv and the cv2 of every unit in a directory')
+    parser.add_argument('directory', help='directory with one file of timestamps per unit')
+    parser.add_argument('--pattern', default='*.txt')
+    parser.add_argument('--output', default='cv2_results.csv', help='result table, .csv or .npz')
+    parser.add_argument('--time-min', type=float, default=0)
+    parser.add_argument('--time-max', type=float, default=10000)
+    parser.add_argument('--max-pair-mean', type=float, default=0.1)
+    parser.add_argument('--isi-pair-bin', type=float, default=0.01)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--binary-cache', action='store_true',
+                        help='write a .spk file next to every text file, later runs memory-map it')
+    parser.add_argument('--plot', action='store_true', help='draw the binned cv2 of every unit')
+    args = parser.parse_args()
+
+    batch_results = batch_cv2_from_directory(args.directory, args.pattern,
+                                             time_min=args.time_min, time_max=args.time_max,
+                                             max_pair_mean=args.max_pair_mean, isi_pair_bin=args.isi_pair_bin,
+                                             binary_cache=args.binary_cache, processes=args.processes)
+    save_batch_results(batch_results, args.output)
+    if args.plot:
+        draw_batch_results(batch_results)
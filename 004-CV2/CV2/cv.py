@@ -1,5 +1,5 @@
 import numpy as np
-from CV2.utils.read_data import read_from_txt
+from CV2.utils.read_data import load_spike_train
 from CV2.utils.signal_generator import generate_possion_process
 from CV2.utils.signal_generator import generate_gamma_process
 
@@ -10,9 +10,65 @@ def get_cv(isis):
     return cv
 
 
+class CVAccumulator:
+    def __init__(self):
+        r"""
+        Accumulate the coefficient of variation of the ISIs of a spike train whose spikes arrive one at a time
+        or in small batches. The running mean and variance of the ISIs are updated with Welford's algorithm,
+        so each spike costs O(1) and cv equals get_cv on all the ISIs received so far.
+        """
+        self.last_spike = None
+        self.isi_number = 0
+        self.isi_mean = 0.0
+        # Sum of the squared differences from the mean
+        self.isi_m2 = 0.0
+
+    def add(self, spike_time: float):
+        r"""
+        Add one spike, later than all the spikes added before.
+        """
+        if self.last_spike is not None:
+            isi = spike_time - self.last_spike
+            self.isi_number += 1
+            delta = isi - self.isi_mean
+            self.isi_mean += delta / self.isi_number
+            self.isi_m2 += delta * (isi - self.isi_mean)
+        self.last_spike = spike_time
+
+    def extend(self, spike_times):
+        r"""
+        Add a batch of sorted spikes, later than all the spikes added before.
+        The statistics of the batch are merged with the running ones (Chan et al.).
+        """
+        spike_times = np.asarray(spike_times, dtype=np.float64)
+        if self.last_spike is not None:
+            spike_times = np.concatenate(([self.last_spike], spike_times))
+        if len(spike_times):
+            self.last_spike = spike_times[-1]
+        if len(spike_times) < 2:
+            return
+
+        isis = np.diff(spike_times)
+        batch_number = len(isis)
+        batch_mean = isis.mean()
+        batch_m2 = ((isis - batch_mean) ** 2).sum()
+
+        number = self.isi_number + batch_number
+        delta = batch_mean - self.isi_mean
+        self.isi_mean += delta * batch_number / number
+        self.isi_m2 += batch_m2 + delta ** 2 * self.isi_number * batch_number / number
+        self.isi_number = number
+
+    @property
+    def cv(self):
+        if self.isi_number == 0:
+            return np.nan
+        return np.sqrt(self.isi_m2 / self.isi_number) / self.isi_mean
+
+
 if __name__ == '__main__':
     file_name = 'datas/Neuron04a.txt'
-    datas = read_from_txt(file_name)
+    datas = load_spike_train(file_name)
 
     # 完全平均的spike trains的cv值为0
     # datas = np.linspace(1,1000,1000)
@@ -1,6 +1,9 @@
-import math
+from bisect import bisect_right
+
 import numpy as np
-from CV2.utils.read_data import read_from_txt
+from CV2.utils.read_data import load_spike_train
+from CV2.utils.result_cache import ResultCache
+from CV2.utils.spike_train import as_spike_train
 from CV2.utils.signal_generator import generate_possion_process
 from CV2.utils.signal_generator import generate_gamma_process
 import matplotlib.pyplot as plt
@@ -11,13 +14,15 @@ def get_cv2(spk_train: list,
             time_max: float = 10000,
             max_pair_mean: float = 0.1,
             isi_pair_bin: float = 0.01,
-            dot_size: float = 0.5):
+            dot_size: float = 0.5,
+            plot: bool = False,
+            result_cache: ResultCache = None):
     r"""
     Calculate the coefficient of variation
 
     Parameters
     ----------
-    spk_train: list
+    spk_train: list or SpikeTrain
         The spike times for one single unit in seconds.
     time_min: float
         Only the timestamps in time interval [time_min, time_max] will be selected for analysis
@@ -29,6 +34,11 @@ def get_cv2(spk_train: list,
         Bin size for calculation of cv2
     dot_size: float
         The size of the dot in the graph
+    plot: bool
+        If True, draw the cv2 graph (see draw_cv2). Nothing is drawn by default, so that it can run headless.
+    result_cache: ResultCache
+        If given, the result is looked up in and stored into this on-disk cache, keyed by the spike times
+        and the parameters.
 
     Returns
     -------
@@ -44,49 +54,237 @@ def get_cv2(spk_train: list,
        [2] https://www.neuroexplorer.com/docs/reference/analysis/types/trainstruct/CVTwo.html
     """
 
+    spike_train = as_spike_train(spk_train)
+    if result_cache is not None:
+        key = result_cache.get_key('get_cv2', [spike_train], {'time_min': time_min, 'time_max': time_max,
+                                                              'max_pair_mean': max_pair_mean,
+                                                              'isi_pair_bin': isi_pair_bin})
+        result = result_cache.load(key)
+        if result is None:
+            result = get_cv2(spike_train, time_min, time_max, max_pair_mean, isi_pair_bin)
+            result_cache.store(key, {name: value for name, value in result.items() if name != 'timestamps'})
+        result['timestamps'] = spk_train
+        result['mean_cv2'] = float(result['mean_cv2'])
+        result['mean_of_isi_bin_middle'] = list(result['mean_of_isi_bin_middle'])
+        result['cv2_mean_of_bin'] = list(result['cv2_mean_of_bin'])
+        if plot:
+            draw_cv2(result, max_pair_mean, dot_size)
+        return result
+
     result = {}
-    # Calculate the ISIs(interspike intervals) of the spk_train
-    isis = [spk_train[i + 1] - spk_train[i] for i in range(len(spk_train) - 1) if time_min <= spk_train[i] <= time_max]
+    # Calculate the ISIs(interspike intervals) of the spk_train, the ones starting in [time_min, time_max]
+    first, last = spike_train.index_range(time_min, time_max)
+    isis = spike_train.isis[first:max(first, min(last, len(spike_train) - 1))]
     # Calculate the mean of two adjacent ISIs
-    mean_of_isi = [(isis[i + 1] + isis[i]) / 2 for i in range(len(isis) - 1)]
+    mean_of_isi = (isis[1:] + isis[:-1]) / 2
     # Calculate the coefficient of variation of the ISIs
     # For spike i we compute the standard deviation of two adjacent ISIs, divide the result by their mean
-    cv2 = [(2 * (abs(isis[i + 1] - isis[i])) / (isis[i + 1] + isis[i] + 1e-9))
-           for i in range(len(isis) - 1)]
-    cv2 = np.array(cv2)
-
-    value_mean_cv2_bins = []
-    index_mean_cv2_bins = []
-    for i in np.arange(isi_pair_bin, max_pair_mean + isi_pair_bin, isi_pair_bin):
-        # Collate every cv2‘s in every bin and calculate the mean of cv2 in every bin
-        indexs = [index for index, value in enumerate(mean_of_isi) if i - isi_pair_bin <= value < i]
-        value_mean_cv2_bins.append(cv2[indexs])
-        index_mean_cv2_bins.append(i - isi_pair_bin / 2)
-
-    # plt.boxplot(value_mean_cv2_bins, positions=index_mean_cv2_bins, showcaps=True,
-    #             showmeans=False, widths=0.005, whis=1, showfliers=False, manage_ticks=False)
-    plt.scatter(mean_of_isi, cv2, s=dot_size)
-    plt.xlim(0, max_pair_mean)
-    plt.ylim(0)
-    plt.show()
+    cv2 = 2 * np.abs(isis[1:] - isis[:-1]) / (isis[1:] + isis[:-1] + 1e-9)
 
-    cv2_mean_of_bin = []
-    for value_mean_cv2_bin in value_mean_cv2_bins:
-        cv2_mean_of_bin.append(np.mean(value_mean_cv2_bin))
+    # Collate every cv2‘s in every bin and calculate the mean of cv2 in every bin, in a single pass
+    bin_edges = get_pair_mean_bin_edges(max_pair_mean, isi_pair_bin)
+    bin_count, bin_sum = _bin_cv2_by_pair_mean(mean_of_isi, cv2, bin_edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cv2_mean_of_bin = bin_sum / bin_count
 
     result['timestamps'] = spk_train
     result['cv2'] = cv2
-    result['mean_cv2'] = sum(cv2) / len(cv2)
+    result['mean_cv2'] = cv2.mean()
     result['mean_of_isi_pair'] = mean_of_isi
-    result['mean_of_isi_bin_middle'] = index_mean_cv2_bins
-    result['cv2_mean_of_bin'] = cv2_mean_of_bin
+    result['mean_of_isi_bin_middle'] = list(bin_edges[:-1] + isi_pair_bin / 2)
+    result['cv2_mean_of_bin'] = list(cv2_mean_of_bin)
+
+    if plot:
+        draw_cv2(result, max_pair_mean, dot_size)
 
     return result
 
 
+def draw_cv2(result: dict,
+             max_pair_mean: float = 0.1,
+             dot_size: float = 0.5):
+    r"""
+    Draw the graph shows ISI variability versus Mean of ISI Pair.
+
+    Parameters
+    ----------
+    result: dict
+        The result of get_cv2.
+    max_pair_mean: float
+        The maximum of x axis.
+    dot_size: float
+        The size of the dot in the graph
+    """
+    plt.scatter(result['mean_of_isi_pair'], result['cv2'], s=dot_size)
+    plt.xlim(0, max_pair_mean)
+    plt.ylim(0)
+    plt.show()
+
+
+def get_cv2_from_chunks(chunks,
+                        time_min: float = 0,
+                        time_max: float = 10000,
+                        max_pair_mean: float = 0.1,
+                        isi_pair_bin: float = 0.01):
+    r"""
+    Calculate the coefficient of variation from consecutive chunks of one spike train (see iter_from_txt),
+    without materialising the whole train.
+
+    Parameters
+    ----------
+    chunks: iterable of array_like
+        Consecutive chunks of the sorted spike times for one single unit in seconds. When the chunks are read
+        with a time range, it has to keep the spike following time_max, as the last ISI ends there
+        (iter_from_txt(..., time_max=time_max, include_next=True)).
+    time_min, time_max, max_pair_mean, isi_pair_bin:
+        See get_cv2.
+
+    Returns
+    -------
+    result: dict with the keys 'mean_cv2', 'mean_of_isi_bin_middle' and 'cv2_mean_of_bin' of get_cv2.
+    The per spike values ('timestamps', 'cv2', 'mean_of_isi_pair') are not kept.
+    """
+    accumulator = CV2Accumulator(time_min, time_max, max_pair_mean, isi_pair_bin)
+    for chunk in chunks:
+        accumulator.extend(chunk)
+    return accumulator.get_result()
+
+
+class CV2Accumulator:
+    def __init__(self,
+                 time_min: float = 0,
+                 time_max: float = 10000,
+                 max_pair_mean: float = 0.1,
+                 isi_pair_bin: float = 0.01):
+        r"""
+        Accumulate the coefficient of variation of a spike train whose spikes arrive one at a time or in
+        small batches. Each spike costs O(1), and the current values have the same semantics as get_cv2
+        on all the spikes received so far.
+
+        Parameters
+        ----------
+        time_min, time_max, max_pair_mean, isi_pair_bin:
+            See get_cv2.
+        """
+        self.time_min = time_min
+        self.time_max = time_max
+        self.isi_pair_bin = isi_pair_bin
+        self.bin_edges = get_pair_mean_bin_edges(max_pair_mean, isi_pair_bin)
+        self.bin_count = np.zeros(len(self.bin_edges) - 1, dtype=np.int64)
+        self.bin_sum = np.zeros(len(self.bin_edges) - 1)
+        self.cv2_sum = 0.0
+        self.cv2_number = 0
+        # The last spike and the last selected ISI, a new spike only forms a pair with them
+        self.last_spike = None
+        self.last_isi = None
+
+    def add(self, spike_time: float):
+        r"""
+        Add one spike, later than all the spikes added before.
+        """
+        last_spike = self.last_spike
+        self.last_spike = spike_time
+        if last_spike is None:
+            return
+        if not self.time_min <= last_spike <= self.time_max:
+            self.last_isi = None
+            return
+
+        isi = spike_time - last_spike
+        if self.last_isi is not None:
+            mean_of_isi = (isi + self.last_isi) / 2
+            cv2 = 2 * abs(isi - self.last_isi) / (isi + self.last_isi + 1e-9)
+            self.cv2_sum += cv2
+            self.cv2_number += 1
+            index = bisect_right(self.bin_edges, mean_of_isi) - 1
+            if 0 <= index < len(self.bin_count):
+                self.bin_count[index] += 1
+                self.bin_sum[index] += cv2
+        self.last_isi = isi
+
+    def extend(self, spike_times):
+        r"""
+        Add a batch of sorted spikes, later than all the spikes added before.
+        """
+        spike_times = np.asarray(spike_times, dtype=np.float64)
+        if self.last_spike is not None:
+            spike_times = np.concatenate(([self.last_spike], spike_times))
+        if len(spike_times) < 2:
+            self.last_spike = spike_times[-1] if len(spike_times) else self.last_spike
+            return
+
+        selected = (self.time_min <= spike_times[:-1]) & (spike_times[:-1] <= self.time_max)
+        isis = np.diff(spike_times)[selected]
+        if self.last_isi is not None and selected[0]:
+            isis = np.concatenate(([self.last_isi], isis))
+        self.last_spike = spike_times[-1]
+        self.last_isi = isis[-1] if selected[-1] and len(isis) else None
+        if len(isis) < 2:
+            return
+
+        mean_of_isi = (isis[1:] + isis[:-1]) / 2
+        cv2 = 2 * np.abs(isis[1:] - isis[:-1]) / (isis[1:] + isis[:-1] + 1e-9)
+        self.cv2_sum += cv2.sum()
+        self.cv2_number += len(cv2)
+        bin_count, bin_sum = _bin_cv2_by_pair_mean(mean_of_isi, cv2, self.bin_edges)
+        self.bin_count += bin_count
+        self.bin_sum += bin_sum
+
+    @property
+    def mean_cv2(self):
+        return self.cv2_sum / self.cv2_number if self.cv2_number else np.nan
+
+    @property
+    def mean_of_isi_bin_middle(self):
+        return list(self.bin_edges[:-1] + self.isi_pair_bin / 2)
+
+    @property
+    def cv2_mean_of_bin(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return list(self.bin_sum / self.bin_count)
+
+    def get_result(self):
+        r"""
+        Returns
+        -------
+        result: dict with the keys 'mean_cv2', 'mean_of_isi_bin_middle' and 'cv2_mean_of_bin' of get_cv2.
+        """
+        result = {}
+        result['mean_cv2'] = self.mean_cv2
+        result['mean_of_isi_bin_middle'] = self.mean_of_isi_bin_middle
+        result['cv2_mean_of_bin'] = self.cv2_mean_of_bin
+        return result
+
+
+def get_pair_mean_bin_edges(max_pair_mean: float, isi_pair_bin: float):
+    r"""
+    Returns
+    -------
+    bin_edges: the edges of the ISI pair mean bins of get_cv2, from 0 to about max_pair_mean
+    """
+    # The bins are [i - isi_pair_bin, i) for i in np.arange(isi_pair_bin, max_pair_mean + isi_pair_bin, isi_pair_bin)
+    upper_edges = np.arange(isi_pair_bin, max_pair_mean + isi_pair_bin, isi_pair_bin)
+    return np.append(upper_edges - isi_pair_bin, upper_edges[-1])
+
+
+def _bin_cv2_by_pair_mean(mean_of_isi, cv2, bin_edges):
+    r"""
+    Returns
+    -------
+    bin_count: the number of ISI pairs whose mean falls into each bin
+    bin_sum: the sum of the cv2 values of those pairs
+    """
+    bin_number = len(bin_edges) - 1
+    indexs = np.digitize(mean_of_isi, bin_edges) - 1
+    inside = (indexs >= 0) & (indexs < bin_number)
+    bin_count = np.bincount(indexs[inside], minlength=bin_number)
+    bin_sum = np.bincount(indexs[inside], weights=cv2[inside], minlength=bin_number)
+    return bin_count, bin_sum
+
+
 if __name__ == '__main__':
     file_name = 'datas/Neuron04a.txt'
-    datas = read_from_txt(file_name)
+    datas = load_spike_train(file_name)
 
     # 完全平均的spike trains的cv值为0
     # datas = np.linspace(1,1000,1000)
@@ -98,4 +296,4 @@ if __name__ == '__main__':
     # datas = generate_possion_process(10000, 1)
 
     # datas = generate_gamma_process(10, 0.1, 10000)
-    print(get_cv2(datas))
+    print(get_cv2(datas, plot=True))
@@ -0,0 +1,86 @@
+import numpy as np
+from CV2.utils.read_data import load_spike_train
+from CV2.utils.spike_train import as_spike_train
+import matplotlib.pyplot as plt
+
+
+class CV2Time:
+    def __init__(self,
+                 spk_train: list,
+                 start: float = 0,
+                 duration: float = 10,
+                 shift: float = 1,
+                 number_of_shift: int = 20):
+        r"""
+        Calculate the mean cv2 versus time in sliding windows
+
+        Parameters
+        ----------
+        spk_train: list or SpikeTrain
+            The spike times for one single unit in seconds.
+        start: float
+            Start of the first sliding window in seconds.
+        duration: float
+            Duration of the sliding window in seconds.
+        shift: float
+            How much sliding window is shifted each time.
+        number_of_shift: int
+            The number of sliding windows to be used.
+
+        The cv2 of every ISI pair is calculated once, each window is then answered with two binary searches
+        and a difference of cumulative sums, so the windows may overlap at no extra cost. The mean cv2 of a
+        window is the same as the 'mean_cv2' of get_cv2 with time_min and time_max set to the window.
+
+        References
+        ----------
+        .. [1] https://www.neuroexplorer.com/docs/reference/analysis/types/trainstruct/CVTwo.html
+        """
+        self.spk_train = as_spike_train(spk_train)
+        self.start = start
+        self.duration = duration
+        self.shift = shift
+        self.number_of_shift = number_of_shift
+        self.window_start = self.start + np.arange(self.number_of_shift) * self.shift
+        self.cv2_number, self.cv2_time = self._get_cv2_time()
+
+    def _get_cv2_time(self):
+        r"""
+        Calculate the mean cv2 of every window.
+
+        Returns
+        -------
+        cv2_number: the number of ISI pairs in every window
+        cv2_time: the mean cv2 in every window, nan if the window has no ISI pair
+        """
+        isis = self.spk_train.isis
+        # cv2 of the pair (isis[k], isis[k + 1]), it is selected when both isis start inside the window
+        cv2 = 2 * np.abs(isis[1:] - isis[:-1]) / (isis[1:] + isis[:-1] + 1e-9)
+        cv2_cumsum = np.concatenate(([0.0], np.cumsum(cv2)))
+
+        # The selected isis are the ones starting at spikes [first, last)
+        first = np.minimum(np.searchsorted(self.spk_train.times, self.window_start, side='left'), len(cv2))
+        last = np.searchsorted(self.spk_train.times, self.window_start + self.duration, side='right')
+        last = np.minimum(last, len(isis))
+        # So the selected pairs are [first, last - 1)
+        pair_end = np.maximum(first, last - 1)
+        cv2_number = pair_end - first
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cv2_time = (cv2_cumsum[pair_end] - cv2_cumsum[first]) / cv2_number
+        return cv2_number, cv2_time
+
+    def draw_cv2_time(self):
+        r"""
+        Draw the graph shows the mean cv2 versus time
+        """
+        plt.plot(self.window_start, self.cv2_time)
+        plt.xlabel('Window start (s)')
+        plt.ylabel('CV2')
+        plt.show()
+
+
+if __name__ == '__main__':
+    file_name = 'datas/Neuron04a.txt'
+    datas = load_spike_train(file_name)
+    test = CV2Time(datas, start=0, duration=100, shift=10, number_of_shift=50)
+    test.draw_cv2_time()
+    print(test.cv2_time)
@@ -0,0 +1,97 @@
+from functools import partial
+
+import numpy as np
+from CV2.cv2 import get_pair_mean_bin_edges
+from CV2.utils.read_data import load_spike_train
+from CV2.utils.surrogate import jitter_spikes, shuffle_isis, surrogate_test
+
+
+def cv2_significance(spk_train: list,
+                     time_min: float = 0,
+                     time_max: float = 10000,
+                     max_pair_mean: float = 0.1,
+                     isi_pair_bin: float = 0.01,
+                     method: str = 'ISI shuffling',
+                     jitter: float = 0.005,
+                     number_of_surrogates: int = 1000,
+                     batch_size: int = 50,
+                     processes: int = None,
+                     seed: int = None,
+                     confidence: float = 0.95):
+    r"""
+    Test the mean cv2 and the cv2 of every ISI pair mean bin against surrogate spike trains.
+
+    Parameters
+    ----------
+    spk_train: list
+        The sorted spike times for one single unit in seconds.
+    time_min, time_max, max_pair_mean, isi_pair_bin:
+        See get_cv2.
+    method: str
+        'ISI shuffling' keeps the ISI distribution and destroys the order of the ISIs,
+        'Spike jitter' moves every spike uniformly within [-jitter, jitter].
+    jitter: float
+        The jitter in seconds, for 'Spike jitter'.
+    number_of_surrogates, batch_size, processes, seed, confidence:
+        See surrogate_test.
+
+    Returns
+    -------
+    result: dict of surrogate_test, element 0 of every statistic is the mean cv2 and the others are the
+    cv2 of the bins in 'mean_of_isi_bin_middle'.
+    """
+    data = {'spk_train': np.asarray(spk_train, dtype=np.float64)}
+    statistic = partial(_cv2_statistic, time_min=time_min, time_max=time_max,
+                        max_pair_mean=max_pair_mean, isi_pair_bin=isi_pair_bin)
+    if method == 'ISI shuffling':
+        make_surrogates = _shuffle_isis_surrogates
+    elif method == 'Spike jitter':
+        make_surrogates = partial(_jitter_surrogates, jitter=jitter)
+    else:
+        raise ValueError(f'Unknown surrogate method {method}')
+
+    observed = statistic(data, data['spk_train'][None, :])[0]
+    result = surrogate_test(statistic, make_surrogates, data, observed, number_of_surrogates,
+                            batch_size, processes, seed, confidence)
+    result['mean_of_isi_bin_middle'] = get_pair_mean_bin_edges(max_pair_mean, isi_pair_bin)[:-1] + isi_pair_bin / 2
+    return result
+
+
+def _cv2_statistic(data, surrogates, time_min, time_max, max_pair_mean, isi_pair_bin):
+    # The same as get_cv2, for every row of surrogates at once
+    selected = (time_min <= surrogates[:, :-1]) & (surrogates[:, :-1] <= time_max)
+    isis = np.diff(surrogates, axis=1)
+    selected_pair = selected[:, 1:] & selected[:, :-1]
+    mean_of_isi = (isis[:, 1:] + isis[:, :-1]) / 2
+    cv2 = 2 * np.abs(isis[:, 1:] - isis[:, :-1]) / (isis[:, 1:] + isis[:, :-1] + 1e-9)
+
+    bin_edges = get_pair_mean_bin_edges(max_pair_mean, isi_pair_bin)
+    bin_number = len(bin_edges) - 1
+    indexs = np.digitize(mean_of_isi, bin_edges) - 1
+    inside = selected_pair & (indexs >= 0) & (indexs < bin_number)
+    # Give every row its own range of bins, so that one bincount covers the whole batch
+    indexs = (indexs + bin_number * np.arange(len(surrogates))[:, None])[inside]
+    bin_count = np.bincount(indexs, minlength=len(surrogates) * bin_number).reshape(len(surrogates), bin_number)
+    bin_sum = np.bincount(indexs, weights=cv2[inside],
+                          minlength=len(surrogates) * bin_number).reshape(len(surrogates), bin_number)
+
+    statistic = np.empty((len(surrogates), 1 + bin_number))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistic[:, 0] = (cv2 * selected_pair).sum(axis=1) / selected_pair.sum(axis=1)
+        statistic[:, 1:] = bin_sum / bin_count
+    return statistic
+
+
+def _shuffle_isis_surrogates(data, rng, number):
+    return shuffle_isis(data['spk_train'], rng, number)
+
+
+def _jitter_surrogates(data, rng, number, jitter):
+    return jitter_spikes(data['spk_train'], rng, number, jitter)
+
+
+if __name__ == '__main__':
+    file_name = 'datas/Neuron04a.txt'
+    datas = load_spike_train(file_name)
+    significance = cv2_significance(datas, number_of_surrogates=200, seed=0)
+    print(significance['observed'][0], significance['p_value'][0])
@@ -14,6 +14,225 @@ def generate_gamma_process(shape, scale, size):
     return spike_times
 
 
+def generate_poisson_trains(rng: np.random.Generator,
+                            rate: float,
+                            duration: float,
+                            number_of_trains: int = 1,
+                            refractory: float = 0.0,
+                            ragged: bool = True):
+    r"""
+    Generate homogeneous Poisson spike trains, all of them in one call.
+
+    Parameters
+    ----------
+    rng: np.random.Generator
+        The random generator, e.g. np.random.default_rng(seed).
+    rate: float
+        Firing rate in Hz, before the refractory period is applied.
+    duration: float
+        Duration of every train in seconds, the spikes lie in [0, duration).
+    number_of_trains: int
+        The number of trains.
+    refractory: float
+        Absolute refractory period in seconds, added to every ISI (dead time Poisson process).
+    ragged: bool
+        See generate_renewal_trains.
+
+    Returns
+    -------
+    See generate_renewal_trains.
+    """
+    def draw_isis(size):
+        return refractory + rng.exponential(1 / rate, size)
+
+    return generate_renewal_trains(draw_isis, refractory + 1 / rate, duration, number_of_trains, ragged)
+
+
+def generate_gamma_trains(rng: np.random.Generator,
+                          shape: float,
+                          scale: float,
+                          duration: float,
+                          number_of_trains: int = 1,
+                          refractory: float = 0.0,
+                          ragged: bool = True):
+    r"""
+    Generate gamma renewal spike trains, all of them in one call. The ISIs are refractory + Gamma(shape, scale).
+
+    Parameters
+    ----------
+    rng: np.random.Generator
+        The random generator, e.g. np.random.default_rng(seed).
+    shape: float
+        Shape of the gamma distribution of the ISIs, 1 gives a Poisson process.
+    scale: float
+        Scale of the gamma distribution of the ISIs in seconds, the mean ISI is shape * scale.
+    duration, number_of_trains, refractory, ragged:
+        See generate_poisson_trains.
+
+    Returns
+    -------
+    See generate_renewal_trains.
+    """
+    def draw_isis(size):
+        return refractory + rng.gamma(shape, scale, size)
+
+    return generate_renewal_trains(draw_isis, refractory + shape * scale, duration, number_of_trains, ragged)
+
+
+def generate_renewal_trains(draw_isis,
+                            mean_isi: float,
+                            duration: float,
+                            number_of_trains: int = 1,
+                            ragged: bool = True):
+    r"""
+    Generate renewal spike trains from an ISI distribution. The ISIs of all trains are drawn into one
+    (trains, spikes) array, which is extended until every train has passed duration.
+
+    Parameters
+    ----------
+    draw_isis: callable
+        draw_isis(size) returns an array of independent ISIs of the given shape.
+    mean_isi: float
+        The mean ISI, used to guess how many ISIs have to be drawn.
+    duration: float
+        Duration of every train in seconds, the spikes lie in [0, duration).
+    number_of_trains: int
+        The number of trains.
+    ragged: bool
+        If True, return the trains as (offsets, values). If False, as one 2-D array.
+
+    Returns
+    -------
+    If ragged, offsets: int array of shape (number_of_trains + 1,) and values: float64 array of all the spike times,
+    the spikes of train i are values[offsets[i]:offsets[i + 1]].
+    Otherwise, spike_times: float64 array of shape (number_of_trains, longest train) padded with nan.
+    """
+    expected = duration / mean_isi
+    size = int(expected + 5 * math.sqrt(expected) + 10)
+    spike_times = np.cumsum(draw_isis((number_of_trains, size)), axis=1)
+    # Rarely some train has not reached duration yet, draw more ISIs for all trains
+    while spike_times.size and spike_times[:, -1].min() < duration:
+        more = spike_times[:, -1:] + np.cumsum(draw_isis((number_of_trains, size)), axis=1)
+        spike_times = np.concatenate((spike_times, more), axis=1)
+
+    inside = spike_times < duration
+    counts = inside.sum(axis=1)
+    if not ragged:
+        spike_times = spike_times[:, :counts.max(initial=0)]
+        return np.where(inside[:, :spike_times.shape[1]], spike_times, np.nan)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return offsets, spike_times[inside]
+
+
+def generate_inhomogeneous_poisson_trains(rng: np.random.Generator,
+                                          rate_function,
+                                          max_rate: float,
+                                          duration: float,
+                                          number_of_trains: int = 1,
+                                          refractory: float = 0.0,
+                                          ragged: bool = True):
+    r"""
+    Generate inhomogeneous Poisson spike trains by thinning a homogeneous process of rate max_rate.
+
+    Parameters
+    ----------
+    rng: np.random.Generator
+        The random generator, e.g. np.random.default_rng(seed).
+    rate_function: callable
+        rate_function(times) returns the firing rate in Hz at an array of times, at most max_rate.
+    max_rate: float
+        An upper bound of rate_function on [0, duration).
+    duration, number_of_trains, ragged:
+        See generate_poisson_trains.
+    refractory: float
+        Absolute refractory period in seconds, a spike closer than refractory to the previous kept spike
+        of its train is removed.
+
+    Returns
+    -------
+    See generate_renewal_trains.
+    """
+    offsets, values = generate_poisson_trains(rng, max_rate, duration, number_of_trains)
+    keep = rng.random(len(values)) * max_rate < rate_function(values)
+    offsets, values = _select_spikes(offsets, values, keep)
+    if refractory > 0:
+        offsets, values = _apply_refractory(offsets, values, refractory)
+    if ragged:
+        return offsets, values
+    return ragged_to_padded(offsets, values)
+
+
+def iter_poisson_chunks(rng: np.random.Generator,
+                        rate: float,
+                        duration: float,
+                        chunk_duration: float = 100.0,
+                        refractory: float = 0.0):
+    r"""
+    Generate one very long homogeneous Poisson train as consecutive chunks, so that it never has to be held
+    in memory. The chunks can be consumed like the ones of iter_from_txt.
+
+    Parameters
+    ----------
+    rng, rate, refractory:
+        See generate_poisson_trains.
+    duration: float
+        Duration of the whole train in seconds.
+    chunk_duration: float
+        Duration covered by every chunk in seconds.
+
+    Yields
+    ------
+    chunk: float64 array of sorted spike times
+    """
+    chunk_start = 0.0
+    # As in generate_poisson_trains, the train starts with a dead time
+    last_spike = 0.0
+    while chunk_start < duration:
+        chunk_end = min(chunk_start + chunk_duration, duration)
+        # The ISIs of a dead time process are not memoryless, continue from the last spike: the next spike
+        # follows the end of its dead time or the start of the chunk, whichever is later, by an exponential ISI
+        first = max(chunk_start, last_spike + refractory)
+        # generate_poisson_trains adds refractory to the first ISI too, start it refractory earlier
+        _, chunk = generate_poisson_trains(rng, rate, chunk_end - first + refractory, 1, refractory)
+        chunk = chunk + (first - refractory)
+        if len(chunk):
+            last_spike = chunk[-1]
+        chunk_start = chunk_end
+        yield chunk
+
+
+def ragged_to_padded(offsets, values):
+    r"""
+    Convert ragged trains (offsets, values) to a 2-D array padded with nan.
+    """
+    counts = np.diff(offsets)
+    padded = np.full((len(counts), counts.max(initial=0)), np.nan)
+    padded[np.arange(padded.shape[1]) < counts[:, None]] = values
+    return padded
+
+
+def _select_spikes(offsets, values, keep):
+    counts = np.add.reduceat(keep, offsets[:-1]) if len(values) else np.zeros(len(offsets) - 1, dtype=np.int64)
+    # reduceat gives the value at the offset itself for empty trains
+    counts = np.where(np.diff(offsets) > 0, counts, 0)
+    return np.concatenate(([0], np.cumsum(counts))), values[keep]
+
+
+def _apply_refractory(offsets, values, refractory):
+    # Remove the spikes closer than refractory to the previous kept spike, the same as a sequential scan.
+    # A spike is only removed when its predecessor is kept, the rest are compared again in the next round.
+    train_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    while True:
+        too_close = np.zeros(len(values), dtype=bool)
+        too_close[1:] = (np.diff(values) < refractory) & (train_index[1:] == train_index[:-1])
+        removed = too_close.copy()
+        removed[1:] &= ~too_close[:-1]
+        if not removed.any():
+            return offsets, values
+        offsets, values = _select_spikes(offsets, values, ~removed)
+        train_index = train_index[~removed]
+
+
 if __name__ == '__main__':
     T = 10000
     lambda_ = 10
@@ -21,5 +240,9 @@ if __name__ == '__main__':
 
     spike_train = generate_possion_process(T, lambda_)
 
+    rng = np.random.default_rng(0)
+    offsets, values = generate_poisson_trains(rng, rate=lambda_, duration=100, number_of_trains=1000,
+                                              refractory=dt)
+
 
-    # print(spike_train)
\ No newline at end of file
+    # print(spike_train)
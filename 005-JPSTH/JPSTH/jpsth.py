@@ -1,6 +1,15 @@
-import math
+import asyncio
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
 
-from JPSTH.utils.read_data import read_from_txt
+import numpy as np
+import scipy.sparse
+from JPSTH.psth import CachedPSTH, PSTHCache, calculate_cached_psth, calculate_psth, psth_cache, psth_product
+from JPSTH.psth import coarsen_jpsth, coarsen_psth, get_coarsen_factor, get_psth_mean_variance
+from JPSTH.utils.read_data import load_spike_train
+from JPSTH.utils.result_cache import ResultCache
+from JPSTH.utils.spike_train import as_spike_train
 
 
 class JointPeriStimulusTimeHistogram:
@@ -12,7 +21,10 @@ class JointPeriStimulusTimeHistogram:
                  x_max: float = 0.2,
                  bin_size: float = 0.01,
                  normalization: str = 'Raw JPSTH',
-                 matrix_scale: str = 'Color Scale'):
+                 matrix_scale: str = 'Color Scale',
+                 cache: PSTHCache = psth_cache,
+                 executor=None,
+                 result_cache: ResultCache = None):
         r"""
         Calculate the Joint Peri-Stimulus Time Histogram
 
@@ -20,9 +32,9 @@ class JointPeriStimulusTimeHistogram:
         ----------
         reference_data : list
             Specifies a reference neuron or event.
-        select_data : list
+        select_data : list or SpikeTrain
             The neuron of event shown along the vertical axis (the vertical axis shows a neuron selected for analysis)
-        bottom_data : list
+        bottom_data : list or SpikeTrain
             The neuron of event shown along the horizontal axis (the vertical axis shows a neuron selected for analysis)
         x_min : float
             Event stimulus time point left boundary, in seconds.
@@ -34,6 +46,16 @@ class JointPeriStimulusTimeHistogram:
             Scatter matrix normalization.
         matrix_scale : str
             An option on how to draw the scatter matrix (color or black and white).
+        cache : PSTHCache
+            The cache the PSTHs are looked up in, shared by all JPSTHs by default. None disables caching.
+        executor : str or Executor
+            How the two PSTHs, which are independent, are calculated.
+            None runs them one after the other, 'thread' on a thread pool (the NumPy kernels release the GIL),
+            'process' on a process pool, or they are submitted to the given Executor, which is reused and
+            not shut down.
+        result_cache : ResultCache
+            If given, get_processed_jpsth loads the processed JPSTH from this cache on disk when it was already
+            calculated for the same spike trains and options, and stores it into it otherwise.
 
         References
         ----------
@@ -43,6 +65,12 @@ class JointPeriStimulusTimeHistogram:
            [2]Ito H, Tsuji S. Model dependence in quantification of spike
               interdependence by joint peri-stimulus time histogram[J].
               Neural computation, 2000, 12(1): 195-217.
+
+        Notes
+        -----
+        Nothing is calculated here. The PSTHs and the JPSTHs are cached properties calculated on first access,
+        so that get_processed_jpsth only calculates what its normalization needs.
+        get_processed_jpsth_async can be awaited from an event loop without blocking it.
         """
         self.x_min = x_min
         self.x_max = x_max
@@ -51,16 +79,59 @@ class JointPeriStimulusTimeHistogram:
         self.bin_number = int((self.x_max - self.x_min) / self.bin_size)
 
         self.reference_data = reference_data
-        self.select_data = select_data
-        self.bottom_data = bottom_data
-        # Todo 异步
-        # Calculate the PSTH data of two neurons signals
-        self.psth_select_data = self._get_psth(self.select_data)
-        self.psth_bottom_data = self._get_psth(self.bottom_data)
+        self._select_data = select_data
+        self._bottom_data = bottom_data
+        self.cache = cache
+        self.executor = executor
+        self.result_cache = result_cache
         self.normalization = normalization
         self.matrix_scale = matrix_scale
-        # Calculate the data of Joint PSTH
-        self.original_jpsth = self._get_original_jpsth()
+
+    @cached_property
+    def select_data(self):
+        return as_spike_train(self._select_data)
+
+    @cached_property
+    def bottom_data(self):
+        return as_spike_train(self._bottom_data)
+
+    # The PSTH data of two neurons signals, see compute_psths to calculate them concurrently
+    @cached_property
+    def cached_psth_select(self):
+        return self._get_cached_psth(self.select_data)
+
+    @cached_property
+    def cached_psth_bottom(self):
+        return self._get_cached_psth(self.bottom_data)
+
+    @cached_property
+    def psth_select_data(self):
+        return self.cached_psth_select.psth
+
+    @cached_property
+    def psth_bottom_data(self):
+        return self.cached_psth_bottom.psth
+
+    @cached_property
+    def average_psth_select(self):
+        return self.cached_psth_select.mean
+
+    @cached_property
+    def average_psth_bottom(self):
+        return self.cached_psth_bottom.mean
+
+    @cached_property
+    def raw_jpsth(self):
+        # The data of Joint PSTH, summed over the trials
+        return self._get_raw_jpsth()
+
+    @cached_property
+    def average_jpsth(self):
+        return self._get_average_jpsth()
+
+    @cached_property
+    def predict_jpsth(self):
+        return self._get_predict_jpsth()
 
     def _get_original_jpsth(self):
         """
@@ -70,69 +141,191 @@ class JointPeriStimulusTimeHistogram:
         u, v: Data at bin coordinates (u, v).
 
         The value in the (u, v) window of the JPSTH between neuron i and neuron j in the k-th trial.
+        This (trials, bins, bins) array is not needed by any normalization, only build it to inspect single trials.
 
         Returns
         -------
         jpsth: the original data of Joint PSTH
         """
-        # Todo check data
-        jpsth = [[[0 for _ in range(self.bin_number)] for _ in range(self.bin_number)]
-                 for _ in range(len(self.reference_data))]
-
-        for i in range(len(self.reference_data)):
-            for j in range(len(self.psth_bottom_data[i])):
-                for k in range(len(self.psth_select_data[i])):
-                    # jpsth[i][j][k] means the data of (j,k) bin in ith trail
-                    jpsth[i][j][k] = self.psth_bottom_data[i][j] * self.psth_select_data[i][k]
+        # jpsth[i][j][k] means the data of (j,k) bin in ith trail
+        psth_bottom, psth_select = self.psth_bottom_data, self.psth_select_data
+        # The per trial cube is dense anyway
+        if scipy.sparse.issparse(psth_bottom):
+            psth_bottom = psth_bottom.toarray()
+        if scipy.sparse.issparse(psth_select):
+            psth_select = psth_select.toarray()
+        return np.einsum('ij,ik->ijk', psth_bottom, psth_select)
+
+    @property
+    def original_jpsth(self):
+        return self._get_original_jpsth()
+
+    def _get_raw_jpsth(self):
+        r"""
+        Calculate $$\sum_{k=1}^{K}{n_{ij}^{(k)}(u,v)}$$ as the matrix product of the (trials, bins) PSTHs,
+        without building the per trial JPSTH. Sparse PSTHs only multiply their non zero bins.
 
-        return jpsth
+        Returns
+        -------
+        jpsth: the sum of the original Joint PSTH over the trials
+        """
+        return psth_product(self.psth_bottom_data, self.psth_select_data)
 
     def get_processed_jpsth(self):
         """
         Returns
         -------
-        processed_jpsth: The data processed by the original_jpsth
-        """
-        processed_jpsth = [[0 for _ in range(self.bin_number)] for _ in range(self.bin_number)]
-        if self.normalization == 'Raw JPSTH':
-            processed_jpsth = self._normalization_raw_jpsth()
-        if self.normalization == 'JPSTH - PSTpred':
-            processed_jpsth = self._normalization_jpsth_pstprod()
-        if self.normalization == '(JPSTH-PSTHpred)/SDpred':
-            processed_jpsth = self._normalization_jpsth_pstprod_sdpred()
+        processed_jpsth: The data processed by the original_jpsth, only the intermediates the normalization
+        needs are calculated
+        """
+        if self.result_cache is None:
+            return self._calculate_processed_jpsth()
+        key = self.result_cache.get_key('JointPeriStimulusTimeHistogram',
+                                        [self.reference_data, self.select_data, self.bottom_data],
+                                        {'x_min': self.x_min, 'x_max': self.x_max, 'bin_size': self.bin_size,
+                                         'normalization': self.normalization})
+        result = self.result_cache.load(key)
+        if result is not None:
+            return result['processed_jpsth']
+        processed_jpsth = self._calculate_processed_jpsth()
+        self.result_cache.store(key, {'processed_jpsth': processed_jpsth})
         return processed_jpsth
 
-    def _normalization_raw_jpsth(self):
+    def _calculate_processed_jpsth(self):
+        with self._open_executor() as executor:
+            if executor is not None:
+                self.compute_psths(executor)
+            if self.normalization == 'Raw JPSTH':
+                return self._normalization_raw_jpsth()
+            if self.normalization == 'JPSTH - PSTpred':
+                return self._normalization_jpsth_pstprod()
+            if self.normalization == '(JPSTH-PSTHpred)/SDpred':
+                return self._normalization_jpsth_pstprod_sdpred()
+        return np.zeros((self.bin_number, self.bin_number))
+
+    async def get_processed_jpsth_async(self):
         """
+        The awaitable get_processed_jpsth, it runs in the default executor of the running event loop,
+        so that the event loop is not blocked.
+
         Returns
         -------
-        jpsth_norm: the data of raw Joint PSTH
-        """
-        jpsth_norm = [[0 for _ in range(self.bin_number)] for _ in
-                      range(self.bin_number)]
-        for i in range(len(self.reference_data)):
-            for j in range(len(self.psth_bottom_data[i])):
-                for k in range(len(self.psth_select_data[i])):
-                    # jpsth_norm[j][k] means the data of (j,k) bin
-                    jpsth_norm[j][k] += self.original_jpsth[i][j][k]
-        return jpsth_norm
+        processed_jpsth: see get_processed_jpsth
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_processed_jpsth)
 
-    def _normalization_jpsth_pstprod(self):
+    def compute_psths(self, executor: Executor = None):
         """
+        Calculate the PSTHs of select_data and bottom_data at the same time, the ones already calculated or
+        found in the cache are not submitted.
+
+        Parameters
+        ----------
+        executor : Executor
+            The executor the two PSTHs are submitted to. Defaults to the executor option of the JPSTH.
+
         Returns
         -------
-        jpsth_norm: the data of Joint PSTH-PSTpred
+        cached_psth_select, cached_psth_bottom: the CachedPSTHs of select_data and bottom_data
+        """
+        if executor is None:
+            with self._open_executor() as executor:
+                if executor is None:
+                    # No executor option, calculate them one after the other
+                    return self.cached_psth_select, self.cached_psth_bottom
+                return self.compute_psths(executor)
+
+        futures = {name: self._submit_cached_psth(executor, target_data) for name, target_data in
+                   (('cached_psth_select', self.select_data), ('cached_psth_bottom', self.bottom_data))
+                   if name not in self.__dict__}
+        for name, (future, key) in futures.items():
+            cached_psth = future.result()
+            if key is not None:
+                self.cache.store(key, cached_psth)
+            # Fill the cached properties
+            self.__dict__[name] = cached_psth
+        return self.cached_psth_select, self.cached_psth_bottom
+
+    def _submit_cached_psth(self, executor, target_data):
+        """
+        Returns
+        -------
+        future: Future of the CachedPSTH of target_data
+        key: the key to store it in the cache under, None if it does not have to be stored
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.get_key(self.reference_data, target_data, self.x_min, self.x_max, self.bin_size)
+            cached_psth = self.cache.lookup(key)
+            if cached_psth is not None:
+                future = Future()
+                future.set_result(cached_psth)
+                return future, None
+        # Plain arrays, so that the arguments are cheap to send to a worker process
+        future = executor.submit(calculate_cached_psth, np.asarray(self.reference_data, dtype=np.float64),
+                                 target_data.times, self.x_min, self.x_max, self.bin_size)
+        return future, key
+
+    @contextmanager
+    def _open_executor(self):
         """
-        average_jpsth = self._get_average_jpsth()
-        predict_jpsth = self._get_predict_jpsth()
+        Yields the executor of the executor option, a pool created here is shut down on exit.
+        """
+        if self.executor is None or isinstance(self.executor, Executor):
+            yield self.executor
+        elif self.executor == 'thread':
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                yield executor
+        elif self.executor == 'process':
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                yield executor
+        else:
+            raise ValueError(f"executor has to be None, 'thread', 'process' or an Executor, not {self.executor!r}")
+
+    def coarsen(self, factor: int):
+        """
+        The JPSTH at factor times the bin size, derived from this one by summing adjacent bins of its PSTHs
+        (and of its raw JPSTH, if it is calculated already) instead of binning the spikes again.
+        The variances are the ones of the coarsened PSTHs, they are not sums of the fine variances.
 
-        jpsth_norm = [[0 for _ in range(len(average_jpsth[i]))] for i in range(len(average_jpsth))]
+        Parameters
+        ----------
+        factor : int
+            The number of bins summed into one, it has to divide the number of bins.
 
-        for i in range(len(jpsth_norm)):
-            for j in range(len(jpsth_norm[i])):
-                jpsth_norm[i][j] = average_jpsth[i][j] - predict_jpsth[i][j]
+        Returns
+        -------
+        jpsth: JointPeriStimulusTimeHistogram with bin_size * factor and the same other options
+        """
+        cached_psth_select = CachedPSTH(coarsen_psth(self.cached_psth_select.psth, factor))
+        cached_psth_bottom = CachedPSTH(coarsen_psth(self.cached_psth_bottom.psth, factor))
+        coarse = JointPeriStimulusTimeHistogram(self.reference_data, self._select_data, self._bottom_data,
+                                                self.x_min, self.x_max, self.bin_size * factor, self.normalization,
+                                                self.matrix_scale, self.cache, self.executor, self.result_cache)
+        coarse.bin_number = self.bin_number // factor
+        # Fill the cached properties, the spike trains are shared
+        coarse.__dict__.update(select_data=self.select_data, bottom_data=self.bottom_data,
+                               cached_psth_select=cached_psth_select, cached_psth_bottom=cached_psth_bottom)
+        if 'raw_jpsth' in self.__dict__:
+            coarse.__dict__['raw_jpsth'] = coarsen_jpsth(self.raw_jpsth, factor)
+        return coarse
 
-        return jpsth_norm
+    def _normalization_raw_jpsth(self):
+        """
+        Returns
+        -------
+        jpsth_norm: the data of raw Joint PSTH, a copy of the cached raw_jpsth
+        """
+        return self.raw_jpsth.copy()
+
+    def _normalization_jpsth_pstprod(self):
+        """
+        Returns
+        -------
+        jpsth_norm: the data of Joint PSTH-PSTpred
+        """
+        return self.average_jpsth - self.predict_jpsth
 
     def _normalization_jpsth_pstprod_sdpred(self):
         """
@@ -140,20 +333,12 @@ class JointPeriStimulusTimeHistogram:
         -------
         jpsth_norm: the data of (JPSTH - PSTH-PSTpred)/SDpred
         """
+        # The diagonals of the JPSTH - PSTpred of bottom_data against itself and of select_data against itself
+        # are the variances of their PSTHs over the trials
+        sdpred = _get_sdpred(self.cached_psth_bottom.variance, self.cached_psth_select.variance)
         jpsth_pstprod_ij = self._normalization_jpsth_pstprod()
-        jpsth_pstprod_ii = JointPeriStimulusTimeHistogram(self.reference_data, self.bottom_data, self.bottom_data,
-                                                          self.x_min, self.x_max,
-                                                          self.bin_size,
-                                                          normalization='JPSTH - PSTpred').get_processed_jpsth()
-        jpsth_pstprod_jj = JointPeriStimulusTimeHistogram(self.reference_data, self.select_data, self.select_data,
-                                                          self.x_min, self.x_max,
-                                                          self.bin_size,
-                                                          normalization='JPSTH - PSTpred').get_processed_jpsth()
-        jpsth_norm = [[0 for _ in range(len(jpsth_pstprod_ij[i]))] for i in range(len(jpsth_pstprod_ij))]
-
-        for i in range(len(jpsth_norm)):
-            for j in range(len(jpsth_norm[i])):
-                jpsth_norm[i][j] = jpsth_pstprod_ij[i][j] / math.sqrt(jpsth_pstprod_ii[i][i] * jpsth_pstprod_jj[j][j])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            jpsth_norm = jpsth_pstprod_ij / sdpred
 
         return jpsth_norm
 
@@ -161,23 +346,22 @@ class JointPeriStimulusTimeHistogram:
         """
         Returns
         -------
-        psth: the data of original PSTH
+        psth: the data of original PSTH, int array or, when it is mostly empty, CSR matrix of shape (trials, bins)
         """
-        flag = 0
-        psth = [[0 for _ in range(self.bin_number)] for _ in range(len(self.reference_data))]
+        return calculate_psth(self.reference_data, target_data, self.x_min, self.x_max, self.bin_size, sparse=None)
 
-        for i, event_time in enumerate(self.reference_data):
-            for j in range(flag, len(target_data)):
-                if self.x_min <= target_data[j] - event_time <= self.x_max:
-                    flag = j
-                    while self.x_min <= target_data[j] - event_time <= self.x_max:
-                        psth[i][int((target_data[j] - event_time - self.x_min) / self.bin_size)] += 1
-                        j = j + 1
-                    break
-        return psth
+    def _get_cached_psth(self, target_data):
+        """
+        Returns
+        -------
+        cached_psth: CachedPSTH with the PSTH and its mean and variance over the trials
+        """
+        if self.cache is None:
+            return CachedPSTH(self._get_psth(target_data))
+        return self.cache.get(self.reference_data, target_data, self.x_min, self.x_max, self.bin_size)
 
     def _get_average_psth(self, psth):
-        """
+        r"""
         Calculate$$<n_{i}(u)> =\frac{1}{K}\sum_{k=1}^{K}{n_{i}^{(k)}(u)}$$
         i : Spike trains of neuron i.
         k : The k-th record (corresponding to the time point in reference_data).
@@ -187,15 +371,12 @@ class JointPeriStimulusTimeHistogram:
         -------
         psth: the data of average of PSTH
         """
-        psth_sum = [0 for _ in range(len(psth[0]))]
-        for i in range(len(psth)):
-            for j in range(len(psth[i])):
-                psth_sum[j] += psth[i][j]
-        psth_sum = [number / len(psth) for number in psth_sum]
-        return psth_sum
+        if scipy.sparse.issparse(psth):
+            return get_psth_mean_variance(psth)[0]
+        return np.asarray(psth).mean(axis=0)
 
     def _get_average_jpsth(self):
-        """
+        r"""
         Calculate $$<n_{ij}(u,v)> =\frac{1}{K}\sum_{k=1}^{K}{n_{ij}^{(k)}(u,v)}$$
         i, j: Spike trains of neuron i and neuron j.
         k   : The k-th record (corresponding to the time point in reference_data).
@@ -205,20 +386,10 @@ class JointPeriStimulusTimeHistogram:
         -------
         psth: the data of average of Joint PSTH
         """
-        jpsth_sum = [[0 for _ in range(len(self.original_jpsth[0][i]))] for i in range(len(self.original_jpsth[0]))]
-        for i in range(len(self.original_jpsth)):
-            for j in range(len(self.original_jpsth[i])):
-                for k in range(len(self.original_jpsth[i][j])):
-                    jpsth_sum[j][k] += self.original_jpsth[i][j][k]
-
-        for j in range(len(self.original_jpsth[0])):
-            for k in range(len(self.original_jpsth[0][0])):
-                jpsth_sum[j][k] /= len(self.original_jpsth)
-
-        return jpsth_sum
+        return self.raw_jpsth / len(self.reference_data)
 
     def _get_predict_jpsth(self):
-        """
+        r"""
         Calculate $$\tilde{n}_{ij}(u,v)=<n_i(u)><n_j(v)>$$
         i, j: Spike trains of neuron i and neuron j.
         k   : The k-th record (corresponding to the time point in reference_data).
@@ -228,16 +399,157 @@ class JointPeriStimulusTimeHistogram:
         -------
         psth: the data of predict of Joint PSTH
         """
-        average_psth_select = self._get_average_psth(self.psth_select_data)
-        average_psth_bottom = self._get_average_psth(self.psth_bottom_data)
+        # predict_jpsth[i][j] = average_psth_bottom[i] * average_psth_select[j]
+        return np.outer(self.average_psth_bottom, self.average_psth_select)
+
+
+def get_jpsth_pyramid(reference_data: list,
+                      select_data: list,
+                      bottom_data: list,
+                      x_min: float = -0.2,
+                      x_max: float = 0.2,
+                      bin_sizes: list = (0.001, 0.005, 0.01, 0.05),
+                      **kwargs):
+    r"""
+    Calculate the JPSTH at several bin sizes from one pass over the spikes: the PSTHs are binned once
+    at the finest bin size and every coarser JPSTH is derived by JointPeriStimulusTimeHistogram.coarsen.
+
+    Parameters
+    ----------
+    reference_data, select_data, bottom_data, x_min, x_max:
+        See JointPeriStimulusTimeHistogram.
+    bin_sizes: list
+        The bin sizes in seconds, each one an integer multiple of the smallest one.
+    kwargs:
+        The other options of JointPeriStimulusTimeHistogram.
+
+    Returns
+    -------
+    jpsths: dict from every bin size to its JointPeriStimulusTimeHistogram
+    """
+    finest_bin_size = min(bin_sizes)
+    factors = {bin_size: get_coarsen_factor(finest_bin_size, bin_size) for bin_size in bin_sizes}
+    finest = JointPeriStimulusTimeHistogram(reference_data, select_data, bottom_data, x_min, x_max, finest_bin_size,
+                                            **kwargs)
+    return {bin_size: finest if factor == 1 else finest.coarsen(factor) for bin_size, factor in factors.items()}
+
+
+class JPSTHAccumulator:
+    def __init__(self,
+                 x_min: float = -0.2,
+                 x_max: float = 0.2,
+                 bin_size: float = 0.01):
+        r"""
+        Accumulate the Joint Peri-Stimulus Time Histogram trial by trial, e.g. while the experiment is running.
+        Only running sums of the per trial PSTHs, of their squares and of their outer products are kept,
+        so every trial costs O(B^2) and the JPSTHs can be read at any point without revisiting old trials.
+
+        Parameters
+        ----------
+        x_min, x_max, bin_size:
+            See JointPeriStimulusTimeHistogram.
+        """
+        self.x_min = x_min
+        self.x_max = x_max
+        self.bin_size = bin_size
+        self.bin_number = int((self.x_max - self.x_min) / self.bin_size)
 
-        predict_jpsth = [[0 for _ in range(len(average_psth_bottom))] for _ in range(len(average_psth_select))]
+        self.trial_number = 0
+        # The counts are integers, so the sums are exact and the variances do not suffer from cancellation
+        self.sum_psth_select = np.zeros(self.bin_number, dtype=np.int64)
+        self.sum_psth_bottom = np.zeros(self.bin_number, dtype=np.int64)
+        self.sum_squared_psth_select = np.zeros(self.bin_number, dtype=np.int64)
+        self.sum_squared_psth_bottom = np.zeros(self.bin_number, dtype=np.int64)
+        # sum_jpsth[u][v] = sum_k psth_bottom[k][u] * psth_select[k][v], the raw JPSTH
+        self.sum_jpsth = np.zeros((self.bin_number, self.bin_number), dtype=np.int64)
+
+    def add_trial(self,
+                  event_time: float,
+                  select_spikes: list,
+                  bottom_spikes: list):
+        r"""
+        Add one finished trial.
 
-        for i in range(len(average_psth_bottom)):
-            for j in range(len(average_psth_select)):
-                predict_jpsth[i][j] = average_psth_bottom[i] * average_psth_select[j]
+        Parameters
+        ----------
+        event_time: float
+            The reference event of the trial in seconds.
+        select_spikes: list or SpikeTrain
+            The spike times of the select neuron around the event in seconds, the ones outside of
+            [event_time + x_min, event_time + x_max] are ignored.
+        bottom_spikes: list or SpikeTrain
+            The spike times of the bottom neuron around the event in seconds.
+        """
+        psth_select = calculate_psth([event_time], select_spikes, self.x_min, self.x_max, self.bin_size)[0]
+        psth_bottom = calculate_psth([event_time], bottom_spikes, self.x_min, self.x_max, self.bin_size)[0]
+        self.trial_number += 1
+        self.sum_psth_select += psth_select
+        self.sum_psth_bottom += psth_bottom
+        self.sum_squared_psth_select += psth_select ** 2
+        self.sum_squared_psth_bottom += psth_bottom ** 2
+        self.sum_jpsth += np.outer(psth_bottom, psth_select)
+
+    @property
+    def raw_jpsth(self):
+        return self.sum_jpsth.astype(np.float64)
+
+    @property
+    def average_jpsth(self):
+        return self.sum_jpsth / self.trial_number
+
+    @property
+    def average_psth_select(self):
+        return self.sum_psth_select / self.trial_number
+
+    @property
+    def average_psth_bottom(self):
+        return self.sum_psth_bottom / self.trial_number
+
+    @property
+    def variance_psth_select(self):
+        return self._get_variance(self.sum_psth_select, self.sum_squared_psth_select)
+
+    @property
+    def variance_psth_bottom(self):
+        return self._get_variance(self.sum_psth_bottom, self.sum_squared_psth_bottom)
+
+    @property
+    def predict_jpsth(self):
+        return np.outer(self.average_psth_bottom, self.average_psth_select)
+
+    def get_processed_jpsth(self, normalization: str = 'Raw JPSTH'):
+        """
+        Parameters
+        ----------
+        normalization : str
+            'Raw JPSTH', 'JPSTH - PSTpred' or '(JPSTH-PSTHpred)/SDpred', see JointPeriStimulusTimeHistogram.
 
-        return predict_jpsth
+        Returns
+        -------
+        processed_jpsth: The JPSTH of the trials added so far
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if normalization == 'Raw JPSTH':
+                return self.raw_jpsth
+            if normalization == 'JPSTH - PSTpred':
+                return self.average_jpsth - self.predict_jpsth
+            if normalization == '(JPSTH-PSTHpred)/SDpred':
+                return ((self.average_jpsth - self.predict_jpsth)
+                        / _get_sdpred(self.variance_psth_bottom, self.variance_psth_select))
+        return np.zeros((self.bin_number, self.bin_number))
+
+    def _get_variance(self, sum_psth, sum_squared_psth):
+        # $$<n^2> - <n>^2 = (K \sum n^2 - (\sum n)^2) / K^2$$, the same as CachedPSTH.variance
+        return (self.trial_number * sum_squared_psth - sum_psth ** 2) / self.trial_number ** 2
+
+
+def _get_sdpred(variance_bottom, variance_select):
+    r"""
+    Returns
+    -------
+    sdpred: $$\sqrt{\sigma_i^2(u) \sigma_j^2(v)}$$, the ii/jj term of SDpred
+    """
+    return np.sqrt(np.outer(variance_bottom, variance_select))
 
 
 if __name__ == '__main__':
@@ -245,9 +557,9 @@ if __name__ == '__main__':
     bottom_name = 'datas/Neuron04a.txt'
     reference_name = 'datas/Event04.txt'
 
-    select = read_from_txt(select_name)
-    bottom = read_from_txt(bottom_name)
-    reference = read_from_txt(reference_name)
+    select = load_spike_train(select_name)
+    bottom = load_spike_train(bottom_name)
+    reference = load_spike_train(reference_name)
 
     test = JointPeriStimulusTimeHistogram(reference, select, bottom, x_min=-0.2, x_max=0.2,
                                           bin_size=0.05, normalization='(JPSTH-PSTHpred)/SDpred')
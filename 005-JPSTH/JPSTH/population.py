@@ -0,0 +1,168 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+import scipy.sparse
+from JPSTH.psth import PSTHCache, calculate_cached_psth, psth_cache, psth_product
+from JPSTH.utils.read_data import load_spike_train
+from JPSTH.utils.spike_train import as_spike_train
+
+# The number of PSTH values (trials * bins per neuron) gathered at a time by get_processed_jpsth
+PAIR_BLOCK_SIZE = 2 ** 20
+
+
+class PopulationJPSTH:
+    def __init__(self,
+                 reference_data: list,
+                 spike_trains: list,
+                 x_min: float = -0.2,
+                 x_max: float = 0.2,
+                 bin_size: float = 0.01,
+                 pairs=None,
+                 cache: PSTHCache = psth_cache):
+        r"""
+        Calculate the Joint Peri-Stimulus Time Histograms of many neuron pairs against one list of reference events.
+
+        The (neurons, trials, bins) PSTH tensor is built once, the JPSTHs of the pairs are then computed in
+        batches of matrix products spread across threads (the products run in BLAS, outside the GIL).
+        When any PSTH is mostly empty (fine bins), the PSTHs are kept as a list of sparse matrices instead,
+        and the product of every pair only multiplies the non zero bins.
+
+        Parameters
+        ----------
+        reference_data : list
+            Specifies a reference neuron or event.
+        spike_trains : list
+            The spike trains of the N neurons, lists or SpikeTrains.
+        x_min, x_max, bin_size :
+            See JointPeriStimulusTimeHistogram.
+        pairs : array_like
+            (P, 2) array of neuron indexes (i, j). The JPSTH of a pair is the one of
+            JointPeriStimulusTimeHistogram(reference_data, select_data=spike_trains[j], bottom_data=spike_trains[i]).
+            Defaults to every pair i < j.
+        cache : PSTHCache
+            The cache the PSTHs are looked up in. None disables caching.
+        """
+        self.reference_data = reference_data
+        self.spike_trains = [as_spike_train(spike_train) for spike_train in spike_trains]
+        self.x_min = x_min
+        self.x_max = x_max
+        self.bin_size = bin_size
+        self.bin_number = int((self.x_max - self.x_min) / self.bin_size)
+        if pairs is None:
+            pairs = np.stack(np.triu_indices(len(self.spike_trains), 1), axis=1)
+        self.pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        self.trial_number = len(reference_data)
+
+        cached_psths = [self._get_cached_psth(spike_train, cache) for spike_train in self.spike_trains]
+        # psth[n, k, u]: the PSTH of the n-th neuron in the k-th trial
+        if any(scipy.sparse.issparse(cached_psth.psth) for cached_psth in cached_psths):
+            self.psth = [cached_psth.psth for cached_psth in cached_psths]
+        else:
+            self.psth = np.stack([cached_psth.psth for cached_psth in cached_psths]).astype(np.float64)
+        self.average_psth = np.stack([cached_psth.mean for cached_psth in cached_psths])
+        self.variance_psth = np.stack([cached_psth.variance for cached_psth in cached_psths])
+
+    def _get_cached_psth(self, spike_train, cache):
+        if cache is None:
+            return calculate_cached_psth(self.reference_data, spike_train, self.x_min, self.x_max, self.bin_size)
+        return cache.get(self.reference_data, spike_train, self.x_min, self.x_max, self.bin_size)
+
+    def get_processed_jpsth(self, pairs, normalization: str = 'Raw JPSTH'):
+        r"""
+        Parameters
+        ----------
+        pairs : array_like
+            (P, 2) array of neuron indexes (i, j).
+        normalization : str
+            'Raw JPSTH', 'JPSTH - PSTpred' or '(JPSTH-PSTHpred)/SDpred'.
+
+        Returns
+        -------
+        processed_jpsth: (P, bins, bins) array, the processed JPSTH of every pair
+        """
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        bottom, select = pairs[:, 0], pairs[:, 1]
+        # raw[p, u, v] = sum_k psth[bottom[p], k, u] * psth[select[p], k, v]
+        raw_jpsth = np.empty((len(pairs), self.bin_number, self.bin_number))
+        if isinstance(self.psth, list):
+            for index, (i, j) in enumerate(pairs):
+                raw_jpsth[index] = psth_product(self.psth[i], self.psth[j])
+        else:
+            # Gather the PSTHs of a few pairs at a time, never a (P, trials, bins) copy of them
+            block_pairs = max(1, PAIR_BLOCK_SIZE // max(1, self.trial_number * self.bin_number))
+            for start in range(0, len(pairs), block_pairs):
+                block = slice(start, start + block_pairs)
+                np.matmul(self.psth[bottom[block]].transpose(0, 2, 1), self.psth[select[block]], out=raw_jpsth[block])
+        if normalization == 'Raw JPSTH':
+            return raw_jpsth
+
+        jpsth = (raw_jpsth / self.trial_number
+                 - self.average_psth[bottom][:, :, None] * self.average_psth[select][:, None, :])
+        if normalization == 'JPSTH - PSTpred':
+            return jpsth
+        if normalization == '(JPSTH-PSTHpred)/SDpred':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return jpsth / np.sqrt(self.variance_psth[bottom][:, :, None] * self.variance_psth[select][:, None, :])
+        raise ValueError(f'Unknown normalization {normalization}')
+
+    def iter_processed_jpsth(self,
+                             normalization: str = 'Raw JPSTH',
+                             batch_size: int = 64,
+                             workers: int = None):
+        r"""
+        Calculate the processed JPSTH of every pair of self.pairs, batch_size pairs at a time across workers threads.
+        At most 2 * workers batches are held in memory.
+
+        Yields
+        ------
+        i, j, processed_jpsth: the pair and its (bins, bins) processed JPSTH, in the order of self.pairs
+        """
+        workers = workers or os.cpu_count()
+        batches = (self.pairs[start:start + batch_size] for start in range(0, len(self.pairs), batch_size))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = [(batch, executor.submit(self.get_processed_jpsth, batch, normalization))
+                       for batch in islice(batches, 2 * workers)]
+            while pending:
+                batch, future = pending.pop(0)
+                processed_jpsth = future.result()
+                next_batch = next(batches, None)
+                if next_batch is not None:
+                    pending.append((next_batch, executor.submit(self.get_processed_jpsth, next_batch, normalization)))
+                for (i, j), pair_jpsth in zip(batch, processed_jpsth):
+                    yield int(i), int(j), pair_jpsth
+
+    def save_processed_jpsth(self,
+                             file_name: str,
+                             normalization: str = 'Raw JPSTH',
+                             batch_size: int = 64,
+                             workers: int = None):
+        r"""
+        Stream the processed JPSTH of every pair of self.pairs into a '.npy' file of shape (P, bins, bins),
+        pair by pair as they are computed, so that they never all sit in memory.
+        The pairs are written next to it, into '<file_name without .npy>_pairs.npy'.
+
+        Returns
+        -------
+        processed_jpsth: read-only memory-mapped (P, bins, bins) array of the written file
+        """
+        np.save(os.path.splitext(file_name)[0] + '_pairs.npy', self.pairs)
+        output = np.lib.format.open_memmap(file_name, mode='w+', dtype=np.float64,
+                                           shape=(len(self.pairs), self.bin_number, self.bin_number))
+        for index, (_, _, pair_jpsth) in enumerate(self.iter_processed_jpsth(normalization, batch_size, workers)):
+            output[index] = pair_jpsth
+        output.flush()
+        del output
+        return np.load(file_name, mmap_mode='r')
+
+
+if __name__ == '__main__':
+    reference_name = 'datas/Event04.txt'
+    neuron_names = ['datas/Neuron04a.txt', 'datas/Neuron05b.txt']
+
+    reference = load_spike_train(reference_name)
+    neurons = [load_spike_train(neuron_name) for neuron_name in neuron_names]
+
+    population = PopulationJPSTH(reference, neurons, x_min=-0.2, x_max=0.2, bin_size=0.05)
+    population.save_processed_jpsth('population_jpsth.npy', normalization='(JPSTH-PSTHpred)/SDpred')
@@ -1,41 +1,470 @@
-from JPSTH.utils.read_data import read_from_txt
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+from JPSTH.utils.read_data import load_spike_train
+from JPSTH.utils.spike_train import array_digest, as_spike_train
+
+# The number of in-window spikes binned at a time by calculate_psth
+PSTH_BLOCK_SIZE = 2 ** 22
+# calculate_psth(sparse=None) returns a sparse PSTH when less than this fraction of the bins can be non zero
+SPARSE_PSTH_DENSITY = 0.02
 
 
 def get_sum_psth(psth):
-    psth_sum = [0 for _ in range(len(psth[0]))]
-    for i in range(len(psth)):
-        for j in range(len(psth[i])):
-            psth_sum[j] += psth[i][j]
-    return psth_sum
+    if scipy.sparse.issparse(psth):
+        return np.asarray(psth.sum(axis=0)).ravel()
+    return np.asarray(psth).sum(axis=0)
 
 
 def calculate_psth(reference_data: list,
                    target_data: list,
                    x_min: float = -0.2,
                    x_max: float = 0.2,
-                   bin_size: float = 0.01):
-    flag = 0
-    psth = [[0 for _ in range(int((x_max - x_min)/bin_size))] for _ in range(len(reference_data))]
-
-    for i, event_time in enumerate(reference_data):
-        for j in range(flag, len(target_data)):
-            if x_min <= target_data[j] - event_time <= x_max:
-                flag = j
-                while x_min <= target_data[j] - event_time <= x_max:
-                    psth[i][int((target_data[j] - event_time - x_min) / bin_size)] += 1
-                    j = j + 1
-                break
+                   bin_size: float = 0.01,
+                   sparse: bool = False):
+    r"""
+    Calculate the PSTH of target_data around every reference event.
+
+    The window [event_time + x_min, event_time + x_max] of every trial is found by binary search,
+    and all the offsets inside the windows are binned in one vectorized histogram. The events may overlap
+    and do not have to be sorted.
+
+    Parameters
+    ----------
+    reference_data: list
+        The reference events in seconds.
+    target_data: list or SpikeTrain
+        The spike times of the target neuron in seconds.
+    x_min: float
+        Event stimulus time point left boundary, in seconds.
+    x_max: float
+        Event stimulus time point right boundary, in seconds.
+    bin_size: float
+        Bin size in seconds.
+    sparse: bool
+        If True, return a scipy.sparse CSR matrix, whose memory and binning time grow with the number of spikes
+        in the windows instead of trials * bins. None chooses it when less than SPARSE_PSTH_DENSITY of the
+        bins can be non zero, i.e. for fine bins.
+
+    Returns
+    -------
+    psth: int array of shape (trials, bins), psth[i][j] is the number of spikes in the j-th bin of the i-th trial
+    """
+    bin_number = int((x_max - x_min) / bin_size)
+    reference_data = np.asarray(reference_data, dtype=np.float64)
+    target_data = as_spike_train(target_data).times
+
+    # Search slightly wider windows, the offsets are compared with x_min and x_max exactly below
+    margin = 4 * np.spacing(np.abs(reference_data) + max(abs(x_min), abs(x_max)))
+    first = np.searchsorted(target_data, reference_data + x_min - margin, side='left')
+    last = np.searchsorted(target_data, reference_data + x_max + margin, side='right')
+    if sparse is None:
+        # Every spike in a window fills at most one bin
+        sparse = (last - first).sum() < SPARSE_PSTH_DENSITY * len(reference_data) * bin_number
+
+    blocks = _iter_binned_spikes(reference_data, target_data, first, last, x_min, x_max, bin_size, bin_number)
+    if sparse:
+        trials, indexs = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        for block_trials, block_indexs in blocks:
+            trials.append(block_trials)
+            indexs.append(block_indexs)
+        trials, indexs = np.concatenate(trials), np.concatenate(indexs)
+        # The duplicated (trial, bin) entries are summed up into the counts
+        return scipy.sparse.csr_matrix((np.ones(len(trials), dtype=np.int64), (trials, indexs)),
+                                       shape=(len(reference_data), bin_number))
+
+    psth = np.zeros(len(reference_data) * bin_number, dtype=np.int64)
+    for block_trials, block_indexs in blocks:
+        psth += np.bincount(block_trials * bin_number + block_indexs, minlength=len(psth))
+    return psth.reshape(len(reference_data), bin_number)
+
+
+def calculate_psths(reference_data: list,
+                    target_trains,
+                    x_min: float = -0.2,
+                    x_max: float = 0.2,
+                    bin_size: float = 0.01):
+    r"""
+    Calculate the PSTHs of a batch of target trains of the same length (e.g. surrogates) around the same reference
+    events, all of them at once.
+
+    The trains are laid one after the other on a virtual time axis, far enough apart that the window of an event
+    only finds the spikes of its own train, so that one binary search and one bincount cover the whole batch.
+    The offsets are taken from the real spike times, so every PSTH is the same as the one of calculate_psth.
+
+    Parameters
+    ----------
+    reference_data: list
+        The reference events in seconds.
+    target_trains: array_like
+        (batch, spikes) array of sorted spike times in seconds, one target train per row.
+    x_min, x_max, bin_size:
+        See calculate_psth.
+
+    Returns
+    -------
+    psths: int array of shape (batch, trials, bins), psths[s] is calculate_psth(reference_data, target_trains[s])
+    """
+    bin_number = int((x_max - x_min) / bin_size)
+    reference_data = np.asarray(reference_data, dtype=np.float64)
+    target_trains = np.asarray(target_trains, dtype=np.float64)
+    number, trial_number = len(target_trains), len(reference_data)
+    psths = np.zeros(number * trial_number * bin_number, dtype=np.int64)
+    if not target_trains.size or not trial_number:
+        return psths.reshape(number, trial_number, bin_number)
+
+    # The trial s * trials + k is the k-th event in the s-th train
+    batch_reference_data = np.tile(reference_data, number)
+    # The window of an event is at least 1 second away from the spikes of the other trains
+    max_offset = max(abs(x_min), abs(x_max))
+    period = (max(target_trains.max(), reference_data.max()) - min(target_trains.min(), reference_data.min())
+              + max_offset + 1)
+    shifts = np.repeat(np.arange(number) * period, trial_number)
+    virtual_target = (target_trains + np.arange(number)[:, None] * period).ravel()
+
+    # Search slightly wider windows, the offsets are compared with x_min and x_max exactly in _iter_binned_spikes
+    margin = 4 * np.spacing(np.abs(batch_reference_data) + shifts + max_offset)
+    first = np.searchsorted(virtual_target, batch_reference_data + shifts + x_min - margin, side='left')
+    last = np.searchsorted(virtual_target, batch_reference_data + shifts + x_max + margin, side='right')
+    for block_trials, block_indexs in _iter_binned_spikes(batch_reference_data, target_trains.ravel(), first, last,
+                                                           x_min, x_max, bin_size, bin_number):
+        psths += np.bincount(block_trials * bin_number + block_indexs, minlength=len(psths))
+    return psths.reshape(number, trial_number, bin_number)
+
+
+def _iter_binned_spikes(reference_data, target_data, first, last, x_min, x_max, bin_size, bin_number):
+    r"""
+    Yields
+    ------
+    trials, indexs: the trial and the bin of every spike inside the windows, about PSTH_BLOCK_SIZE spikes at a time
+    """
+    counts = last - first
+    cumulative_counts = np.cumsum(counts)
+    block_start = 0
+    while block_start < len(reference_data):
+        # Bin the trials in blocks, so that the offsets of about PSTH_BLOCK_SIZE spikes are held at a time
+        block_end = int(np.searchsorted(cumulative_counts, cumulative_counts[block_start] - counts[block_start]
+                                        + PSTH_BLOCK_SIZE, side='right'))
+        block_end = max(block_end, block_start + 1)
+        block_counts = counts[block_start:block_end]
+        trials = np.repeat(np.arange(block_start, block_end), block_counts)
+        spikes = (np.repeat(first[block_start:block_end] - np.cumsum(block_counts) + block_counts, block_counts)
+                  + np.arange(block_counts.sum()))
+        offsets = target_data[spikes] - reference_data[trials]
+        indexs = ((offsets - x_min) / bin_size).astype(np.int64)
+        # An offset of exactly x_max would fall into the bin after the last one
+        inside = (x_min <= offsets) & (offsets <= x_max) & (indexs < bin_number)
+        yield trials[inside], indexs[inside]
+        block_start = block_end
+
+
+def psth_product(psth_bottom, psth_select):
+    r"""
+    Calculate $$\sum_{k=1}^{K}{n_{i}^{(k)}(u) n_{j}^{(k)}(v)}$$, the raw JPSTH of two (trials, bins) PSTHs,
+    each one dense or sparse. With a sparse one only the non zero bins are multiplied.
+
+    Returns
+    -------
+    raw_jpsth: float array of shape (bins, bins)
+    """
+    if scipy.sparse.issparse(psth_bottom):
+        raw_jpsth = psth_bottom.T.astype(np.float64) @ psth_select
+    elif scipy.sparse.issparse(psth_select):
+        raw_jpsth = (psth_select.T.astype(np.float64) @ psth_bottom).T
+    else:
+        return psth_bottom.T.astype(np.float64) @ psth_select.astype(np.float64)
+    if scipy.sparse.issparse(raw_jpsth):
+        raw_jpsth = raw_jpsth.toarray()
+    return np.asarray(raw_jpsth, dtype=np.float64)
+
+
+def get_psth_mean_variance(psth):
+    r"""
+    Calculate$$<n_{i}(u)>$$ and $$<n_{i}(u)^2> - <n_{i}(u)>^2$$ over the trials of a dense or sparse PSTH.
+
+    Returns
+    -------
+    mean, variance: float arrays of shape (bins,)
+    """
+    if not scipy.sparse.issparse(psth):
+        return psth.mean(axis=0), psth.var(axis=0)
+    trial_number = psth.shape[0]
+    sum_psth = np.asarray(psth.sum(axis=0), dtype=np.int64).ravel()
+    sum_squared_psth = np.asarray(psth.multiply(psth).sum(axis=0), dtype=np.int64).ravel()
+    # The counts are integers, so the sums are exact and the variance does not suffer from cancellation
+    return (sum_psth / trial_number,
+            (trial_number * sum_squared_psth - sum_psth ** 2) / trial_number ** 2)
+
+
+def calculate_psth_from_chunks(reference_data: list,
+                               target_chunks,
+                               x_min: float = -0.2,
+                               x_max: float = 0.2,
+                               bin_size: float = 0.01):
+    r"""
+    Calculate the PSTH of a target spike train given as consecutive chunks (see iter_from_txt),
+    without materialising the whole train.
+
+    Parameters
+    ----------
+    reference_data: list
+        The reference events in seconds.
+    target_chunks: iterable of array_like
+        Consecutive chunks of the sorted spike times of the target neuron in seconds.
+    x_min, x_max, bin_size:
+        See calculate_psth.
+
+    Returns
+    -------
+    psth: int array of shape (trials, bins)
+    """
+    # Every spike belongs to exactly one chunk, so the PSTH is the sum of the PSTHs of the chunks
+    psth = np.zeros((len(reference_data), int((x_max - x_min) / bin_size)), dtype=np.int64)
+    for chunk in target_chunks:
+        psth += calculate_psth(reference_data, chunk, x_min, x_max, bin_size)
     return psth
 
 
+def calculate_psth_pyramid(reference_data: list,
+                           target_data: list,
+                           x_min: float = -0.2,
+                           x_max: float = 0.2,
+                           bin_sizes: list = (0.001, 0.005, 0.01, 0.05),
+                           sparse: bool = False):
+    r"""
+    Calculate the PSTH at several bin sizes from one pass over the spikes. The spikes are binned once at
+    the finest bin size, every coarser PSTH is the sum of groups of adjacent fine bins (see coarsen_psth).
+
+    Parameters
+    ----------
+    reference_data, target_data, x_min, x_max, sparse:
+        See calculate_psth.
+    bin_sizes: list
+        The bin sizes in seconds, each one an integer multiple of the smallest one.
+
+    Returns
+    -------
+    psths: dict from every bin size to its PSTH
+    """
+    finest_bin_size = min(bin_sizes)
+    fine_psth = calculate_psth(reference_data, target_data, x_min, x_max, finest_bin_size, sparse)
+    return {bin_size: coarsen_psth(fine_psth, get_coarsen_factor(finest_bin_size, bin_size))
+            for bin_size in bin_sizes}
+
+
+def get_coarsen_factor(bin_size: float, coarse_bin_size: float):
+    r"""
+    Returns
+    -------
+    factor: the integer number of bin_size bins in one coarse_bin_size bin, ValueError if it is not an integer
+    """
+    factor = int(round(coarse_bin_size / bin_size))
+    if factor < 1 or not np.isclose(factor * bin_size, coarse_bin_size, rtol=1e-9, atol=0):
+        raise ValueError(f'The bin size {coarse_bin_size} is not an integer multiple of {bin_size}')
+    return factor
+
+
+def coarsen_psth(psth, factor: int):
+    r"""
+    Sum every factor adjacent bins of a dense or sparse (trials, bins) PSTH.
+
+    Parameters
+    ----------
+    psth: array or sparse matrix
+        The PSTH, see calculate_psth.
+    factor: int
+        The number of bins summed into one, it has to divide the number of bins.
+
+    Returns
+    -------
+    psth: the (trials, bins / factor) PSTH, in the representation of the given one
+    """
+    bin_number = _check_coarsen_factor(psth.shape[1], factor)
+    if scipy.sparse.issparse(psth):
+        # Map every fine bin to its coarse bin with a (bins, bins / factor) matrix of ones
+        grouping = scipy.sparse.csr_matrix((np.ones(psth.shape[1], dtype=psth.dtype),
+                                            (np.arange(psth.shape[1]), np.arange(psth.shape[1]) // factor)),
+                                           shape=(psth.shape[1], bin_number))
+        return (psth @ grouping).tocsr()
+    return np.asarray(psth).reshape(psth.shape[0], bin_number, factor).sum(axis=2)
+
+
+def coarsen_jpsth(jpsth, factor: int):
+    r"""
+    Sum every factor x factor block of adjacent bins of a (bins, bins) JPSTH.
+    Only the sums over the trials (e.g. the raw JPSTH) can be coarsened like this, the normalized JPSTHs can not.
+
+    Returns
+    -------
+    jpsth: the (bins / factor, bins / factor) JPSTH
+    """
+    bin_number = _check_coarsen_factor(jpsth.shape[0], factor)
+    return jpsth.reshape(bin_number, factor, bin_number, factor).sum(axis=(1, 3))
+
+
+def _check_coarsen_factor(bin_number, factor):
+    if not isinstance(factor, (int, np.integer)) or factor < 1:
+        raise ValueError(f'The coarsen factor has to be a positive integer, not {factor!r}')
+    if bin_number % factor:
+        raise ValueError(f'The coarsen factor {factor} does not divide the number of bins {bin_number}')
+    return bin_number // factor
+
+
+class CachedPSTH:
+    __slots__ = ('psth', 'mean', 'variance', 'nbytes')
+
+    def __init__(self, psth):
+        r"""
+        The PSTH of one neuron against one list of reference events, with the terms the JPSTH normalizations need.
+
+        Parameters
+        ----------
+        psth: array or sparse matrix
+            int array or CSR matrix of shape (trials, bins), see calculate_psth.
+        """
+        self.psth = psth
+        # Calculate$$<n_{i}(u)>$$ and $$<n_{i}(u)^2> - <n_{i}(u)>^2$$ over the trials
+        self.mean, self.variance = get_psth_mean_variance(psth)
+        self._set_read_only()
+        self.nbytes = sum(array.nbytes for array in self._get_arrays())
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # A CachedPSTH sent back from a worker process arrives with writeable copies of the arrays
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._set_read_only()
+
+    def _set_read_only(self):
+        for array in self._get_arrays():
+            array.flags.writeable = False
+
+    def _get_arrays(self):
+        if scipy.sparse.issparse(self.psth):
+            return self.psth.data, self.psth.indices, self.psth.indptr, self.mean, self.variance
+        return self.psth, self.mean, self.variance
+
+
+def calculate_cached_psth(reference_data: list,
+                          target_data: list,
+                          x_min: float = -0.2,
+                          x_max: float = 0.2,
+                          bin_size: float = 0.01):
+    r"""
+    Calculate the PSTH with its mean and variance over the trials, without looking it up in a cache.
+    The PSTH is sparse when it is mostly empty, see calculate_psth.
+    It is a module level function, so that it can be submitted to a process pool.
+
+    Returns
+    -------
+    cached_psth: CachedPSTH of calculate_psth(reference_data, target_data, x_min, x_max, bin_size, sparse=None)
+    """
+    return CachedPSTH(calculate_psth(reference_data, target_data, x_min, x_max, bin_size, sparse=None))
+
+
+class PSTHCache:
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        r"""
+        A memory capped LRU cache of PSTHs, keyed by (reference events, neuron, x_min, x_max, bin_size).
+        The events and the neuron are keyed by a hash of their content, which a SpikeTrain computes only once.
+
+        Parameters
+        ----------
+        max_bytes: int
+            The PSTHs used least recently are evicted once the cached arrays take more than max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,
+            reference_data: list,
+            target_data: list,
+            x_min: float = -0.2,
+            x_max: float = 0.2,
+            bin_size: float = 0.01):
+        r"""
+        Returns
+        -------
+        cached_psth: CachedPSTH of calculate_psth(reference_data, target_data, x_min, x_max, bin_size, sparse=None),
+        its arrays are shared and read-only
+        """
+        target_data = as_spike_train(target_data)
+        key = self.get_key(reference_data, target_data, x_min, x_max, bin_size)
+        cached_psth = self.lookup(key)
+        if cached_psth is None:
+            cached_psth = calculate_cached_psth(reference_data, target_data, x_min, x_max, bin_size)
+            self.store(key, cached_psth)
+        return cached_psth
+
+    def get_key(self,
+                reference_data: list,
+                target_data: list,
+                x_min: float = -0.2,
+                x_max: float = 0.2,
+                bin_size: float = 0.01):
+        r"""
+        Returns
+        -------
+        key: the key of the PSTH in the cache, for lookup and store
+        """
+        target_data = as_spike_train(target_data)
+        return array_digest(np.asarray(reference_data, dtype=np.float64)), target_data.digest, x_min, x_max, bin_size
+
+    def lookup(self, key: tuple):
+        r"""
+        Returns
+        -------
+        cached_psth: the CachedPSTH stored under key, or None if it is not cached
+        """
+        with self._lock:
+            cached_psth = self._entries.get(key)
+            if cached_psth is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached_psth
+            self.misses += 1
+        return None
+
+    def store(self, key: tuple, cached_psth: CachedPSTH):
+        r"""
+        Store a PSTH calculated outside of the cache, e.g. in a worker, under key.
+        """
+        if cached_psth.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = cached_psth
+                self.current_bytes += cached_psth.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+# The cache shared by every PSTH and JPSTH computation by default
+psth_cache = PSTHCache()
+
+
 if __name__ == '__main__':
     select_name = 'datas/Neuron04a.txt'
     bottom_name = 'datas/Neuron04a.txt'
     reference_name = 'datas/Event04.txt'
 
-    select_data = read_from_txt(select_name)
-    bottom_data = read_from_txt(bottom_name)
-    reference_data = read_from_txt(reference_name)
+    select_data = load_spike_train(select_name)
+    bottom_data = load_spike_train(bottom_name)
+    reference_data = load_spike_train(reference_name)
 
     psth_bottom_data = calculate_psth(reference_data, bottom_data, x_min=-0.2, x_max=0.2, bin_size=0.05)
     # psth_select_data = calculate_psth(reference_data, select_data, x_min=-0.2, x_max=0.2, bin_size=0.05)
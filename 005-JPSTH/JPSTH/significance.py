@@ -0,0 +1,166 @@
+from functools import partial
+
+import numpy as np
+from JPSTH.psth import calculate_psth, calculate_psths
+from JPSTH.utils.read_data import load_spike_train
+from JPSTH.utils.surrogate import jitter_spikes, shuffle_trials, surrogate_test
+
+
+def jpsth_significance(reference_data: list,
+                       select_data: list,
+                       bottom_data: list,
+                       x_min: float = -0.2,
+                       x_max: float = 0.2,
+                       bin_size: float = 0.01,
+                       normalization: str = 'Raw JPSTH',
+                       method: str = 'Trial shuffling',
+                       jitter: float = 0.005,
+                       number_of_surrogates: int = 1000,
+                       batch_size: int = 50,
+                       processes: int = None,
+                       seed: int = None,
+                       confidence: float = 0.95):
+    r"""
+    Test every bin of the processed JPSTH against surrogate data.
+
+    Parameters
+    ----------
+    reference_data, select_data, bottom_data, x_min, x_max, bin_size, normalization:
+        See JointPeriStimulusTimeHistogram.
+    method: str
+        'Trial shuffling' pairs the trials of select_data with randomly permuted trials of bottom_data,
+        which keeps both PSTHs and destroys the trial by trial correlation.
+        'Spike jitter' moves every spike of both neurons uniformly within [-jitter, jitter].
+    jitter: float
+        The jitter in seconds, for 'Spike jitter'.
+    number_of_surrogates, batch_size, processes, seed, confidence:
+        See surrogate_test.
+
+    Returns
+    -------
+    result: dict of surrogate_test, every statistic is a (bins, bins) matrix like get_processed_jpsth
+    """
+    data = {}
+    data['reference_data'] = np.asarray(reference_data, dtype=np.float64)
+    data['select_data'] = np.asarray(select_data, dtype=np.float64)
+    data['bottom_data'] = np.asarray(bottom_data, dtype=np.float64)
+    data['psth_select_data'] = calculate_psth(reference_data, data['select_data'], x_min, x_max, bin_size)
+    data['psth_bottom_data'] = calculate_psth(reference_data, data['bottom_data'], x_min, x_max, bin_size)
+
+    if method == 'Trial shuffling':
+        statistic = partial(_trial_shuffling_statistic, normalization=normalization)
+        make_surrogates = _shuffle_trials_surrogates
+    elif method == 'Spike jitter':
+        statistic = partial(_spike_jitter_statistic, x_min=x_min, x_max=x_max, bin_size=bin_size,
+                            normalization=normalization)
+        make_surrogates = partial(_jitter_surrogates, jitter=jitter)
+    else:
+        raise ValueError(f'Unknown surrogate method {method}')
+
+    observed = _processed_jpsth(data['psth_bottom_data'], data['psth_select_data'][None], normalization)[0]
+    return surrogate_test(statistic, make_surrogates, data, observed, number_of_surrogates,
+                          batch_size, processes, seed, confidence)
+
+
+def psth_significance(reference_data: list,
+                      target_data: list,
+                      x_min: float = -0.2,
+                      x_max: float = 0.2,
+                      bin_size: float = 0.01,
+                      jitter: float = 0.005,
+                      number_of_surrogates: int = 1000,
+                      batch_size: int = 50,
+                      processes: int = None,
+                      seed: int = None,
+                      confidence: float = 0.95):
+    r"""
+    Test every bin of the average PSTH against spike jittered surrogates of target_data.
+
+    Parameters
+    ----------
+    reference_data, target_data, x_min, x_max, bin_size:
+        See calculate_psth.
+    jitter: float
+        Every spike is moved uniformly within [-jitter, jitter] seconds.
+    number_of_surrogates, batch_size, processes, seed, confidence:
+        See surrogate_test.
+
+    Returns
+    -------
+    result: dict of surrogate_test, every statistic is the average PSTH of shape (bins,)
+    """
+    data = {}
+    data['reference_data'] = np.asarray(reference_data, dtype=np.float64)
+    data['target_data'] = np.asarray(target_data, dtype=np.float64)
+    statistic = partial(_average_psth_statistic, x_min=x_min, x_max=x_max, bin_size=bin_size)
+    make_surrogates = partial(_jitter_target_surrogates, jitter=jitter)
+
+    observed = statistic(data, data['target_data'][None])[0]
+    return surrogate_test(statistic, make_surrogates, data, observed, number_of_surrogates,
+                          batch_size, processes, seed, confidence)
+
+
+def _processed_jpsth(psth_bottom, psth_select, normalization):
+    r"""
+    The processed JPSTH of psth_bottom, (trials, bins) or one per surrogate (batch, trials, bins), against every
+    psth_select of a batch (batch, trials, bins).
+    """
+    trial_number = psth_bottom.shape[-2]
+    # raw[s, u, v] = sum_k psth_bottom[(s,) k, u] * psth_select[s, k, v]
+    raw = np.matmul(np.swapaxes(psth_bottom, -1, -2).astype(np.float64), psth_select.astype(np.float64))
+    if normalization == 'Raw JPSTH':
+        return raw
+
+    mean_bottom = psth_bottom.mean(axis=-2)
+    mean_select = psth_select.mean(axis=1)
+    jpsth = raw / trial_number - mean_bottom[..., :, None] * mean_select[:, None, :]
+    if normalization == 'JPSTH - PSTpred':
+        return jpsth
+    if normalization == '(JPSTH-PSTHpred)/SDpred':
+        variance_bottom = (psth_bottom ** 2).mean(axis=-2) - mean_bottom ** 2
+        variance_select = (psth_select ** 2).mean(axis=1) - mean_select ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return jpsth / np.sqrt(variance_bottom[..., :, None] * variance_select[:, None, :])
+    raise ValueError(f'Unknown normalization {normalization}')
+
+
+def _trial_shuffling_statistic(data, surrogates, normalization):
+    return _processed_jpsth(data['psth_bottom_data'], data['psth_select_data'][surrogates], normalization)
+
+
+def _spike_jitter_statistic(data, surrogates, x_min, x_max, bin_size, normalization):
+    select_surrogates, bottom_surrogates = surrogates
+    psth_select = calculate_psths(data['reference_data'], select_surrogates, x_min, x_max, bin_size)
+    psth_bottom = calculate_psths(data['reference_data'], bottom_surrogates, x_min, x_max, bin_size)
+    return _processed_jpsth(psth_bottom, psth_select, normalization)
+
+
+def _average_psth_statistic(data, surrogates, x_min, x_max, bin_size):
+    return calculate_psths(data['reference_data'], surrogates, x_min, x_max, bin_size).mean(axis=1)
+
+
+def _shuffle_trials_surrogates(data, rng, number):
+    return shuffle_trials(len(data['reference_data']), rng, number)
+
+
+def _jitter_surrogates(data, rng, number, jitter):
+    return (jitter_spikes(data['select_data'], rng, number, jitter),
+            jitter_spikes(data['bottom_data'], rng, number, jitter))
+
+
+def _jitter_target_surrogates(data, rng, number, jitter):
+    return jitter_spikes(data['target_data'], rng, number, jitter)
+
+
+if __name__ == '__main__':
+    select_name = 'datas/Neuron05b.txt'
+    bottom_name = 'datas/Neuron04a.txt'
+    reference_name = 'datas/Event04.txt'
+
+    select = load_spike_train(select_name)
+    bottom = load_spike_train(bottom_name)
+    reference = load_spike_train(reference_name)
+
+    significance = jpsth_significance(reference, select, bottom, x_min=-0.2, x_max=0.2, bin_size=0.05,
+                                      normalization='JPSTH - PSTpred', number_of_surrogates=200, seed=0)
+    print(significance['p_value'])
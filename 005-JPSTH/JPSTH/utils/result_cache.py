@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from JPSTH.utils.spike_train import array_digest
+
+RESULT_SUFFIX = '.npz'
+
+
+class ResultCache:
+    def __init__(self,
+                 directory: str,
+                 max_bytes: int = 2 ** 30):
+        r"""
+        A persistent cache of analysis results on disk, one compressed '.npz' file per result, named by a hash
+        of the input timestamps and of all the analysis parameters.
+
+        Several processes can share one directory: a result is written into a temporary file and renamed into
+        place, so that a reader never sees a half written file, and a file removed or replaced by another process
+        while it is read is treated as a miss.
+
+        Parameters
+        ----------
+        directory: str
+            The directory the results are stored in, created if needed.
+        max_bytes: int
+            The results read least recently are removed once the files take more than max_bytes.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, name: str, arrays: list, params: dict):
+        r"""
+        Parameters
+        ----------
+        name: str
+            The name of the analysis.
+        arrays: list
+            The inputs, arrays or SpikeTrains (whose digest is computed only once).
+        params: dict
+            All the other parameters of the analysis, they have to be representable in JSON.
+
+        Returns
+        -------
+        key: hex string hashing the name, the content of the arrays and the parameters
+        """
+        digest = hashlib.sha256(name.encode())
+        for array in arrays:
+            array_key = getattr(array, 'digest', None) or array_digest(np.asarray(array, dtype=np.float64))
+            digest.update(array_key.encode())
+        digest.update(json.dumps(params, sort_keys=True, default=repr).encode())
+        return digest.hexdigest()
+
+    def load(self, key: str):
+        r"""
+        Returns
+        -------
+        result: dict of the arrays stored under key, or None if it is not cached
+        """
+        file_name = self._get_file_name(key)
+        try:
+            with np.load(file_name, allow_pickle=False) as file:
+                result = {name: file[name] for name in file.files}
+            # Mark it as recently used for the eviction
+            os.utime(file_name)
+        except (FileNotFoundError, ValueError, OSError, zipfile.BadZipFile):
+            return None
+        return result
+
+    def store(self, key: str, result: dict):
+        r"""
+        Store a dict of arrays under key, then evict the least recently used results beyond max_bytes.
+        """
+        handle, temp_name = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                np.savez_compressed(file, **result)
+            os.replace(temp_name, self._get_file_name(key))
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+        self.evict()
+
+    def evict(self, max_bytes: int = None):
+        r"""
+        Remove the results read least recently until the files take at most max_bytes (self.max_bytes by default).
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = []
+        with os.scandir(self.directory) as iterator:
+            for entry in iterator:
+                if not entry.name.endswith(RESULT_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        current_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if current_bytes <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Removed by another process already
+                pass
+            current_bytes -= size
+
+    def clear(self):
+        self.evict(0)
+
+    def _get_file_name(self, key):
+        return os.path.join(self.directory, key + RESULT_SUFFIX)
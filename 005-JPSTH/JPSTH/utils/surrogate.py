@@ -0,0 +1,149 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from JPSTH.utils.shared_array import share_array, attach_array
+
+# The shared inputs of the surrogate test, attached once by every worker process
+_worker_data = None
+_worker_shms = None
+
+
+def shuffle_isis(spike_train, rng: np.random.Generator, number: int):
+    r"""
+    ISI shuffling: keep the first spike and the ISIs of the train, in a random order.
+
+    Returns
+    -------
+    surrogates: float64 array of shape (number, spikes), one sorted surrogate train per row
+    """
+    spike_train = np.asarray(spike_train, dtype=np.float64)
+    isis = np.broadcast_to(np.diff(spike_train), (number, len(spike_train) - 1))
+    surrogates = np.empty((number, len(spike_train)))
+    surrogates[:, 0] = spike_train[0]
+    surrogates[:, 1:] = spike_train[0] + np.cumsum(rng.permuted(isis, axis=1), axis=1)
+    return surrogates
+
+
+def jitter_spikes(spike_train, rng: np.random.Generator, number: int, jitter: float):
+    r"""
+    Spike jittering: move every spike uniformly within [-jitter, jitter] seconds.
+
+    Returns
+    -------
+    surrogates: float64 array of shape (number, spikes), one sorted surrogate train per row
+    """
+    spike_train = np.asarray(spike_train, dtype=np.float64)
+    surrogates = spike_train + rng.uniform(-jitter, jitter, (number, len(spike_train)))
+    surrogates.sort(axis=1)
+    return surrogates
+
+
+def shuffle_trials(trial_number: int, rng: np.random.Generator, number: int):
+    r"""
+    Trial shuffling: a random permutation of the trials, e.g. of reference_data, for every surrogate.
+
+    Returns
+    -------
+    surrogates: int array of shape (number, trial_number)
+    """
+    return rng.permuted(np.broadcast_to(np.arange(trial_number), (number, trial_number)), axis=1)
+
+
+def surrogate_test(statistic,
+                   make_surrogates,
+                   data: dict,
+                   observed,
+                   number_of_surrogates: int = 1000,
+                   batch_size: int = 50,
+                   processes: int = None,
+                   seed: int = None,
+                   confidence: float = 0.95):
+    r"""
+    Compare a statistic with its distribution over surrogate data.
+
+    The inputs are placed in shared memory once. The surrogates are generated and evaluated in batches across
+    a process pool, every batch goes through the vectorized statistic in one call.
+
+    Parameters
+    ----------
+    statistic: callable
+        statistic(data, surrogates) returns an array of shape (batch, ...) with the statistic of every surrogate.
+        It has to be picklable, e.g. a module level function or a functools.partial of one.
+    make_surrogates: callable
+        make_surrogates(data, rng, number) returns a batch of number surrogates, the input of statistic.
+        It has to be picklable.
+    data: dict
+        The input arrays, {name: array}.
+    observed: array_like
+        The statistic of the original data, of shape (...).
+    number_of_surrogates: int
+        The number of surrogates, at least 1.
+    batch_size: int
+        The number of surrogates generated and evaluated at a time.
+    processes: int
+        The number of worker processes. Defaults to the number of cores, 1 runs in the calling process.
+    seed: int
+        The seed of the surrogates, every batch gets its own independent stream.
+    confidence: float
+        The coverage of the confidence band.
+
+    Returns
+    -------
+    result: dict with the keys
+        'observed', 'surrogate_mean',
+        'p_value_greater', 'p_value_less' (one-sided) and 'p_value' (two-sided), per element of the statistic,
+        'lower' and 'upper', the pointwise confidence band of the surrogates.
+    """
+    if number_of_surrogates < 1:
+        raise ValueError(f'The number of surrogates has to be at least 1, not {number_of_surrogates!r}')
+    if batch_size < 1:
+        raise ValueError(f'The batch size has to be at least 1, not {batch_size!r}')
+    observed = np.asarray(observed, dtype=np.float64)
+    batch_sizes = [min(batch_size, number_of_surrogates - start) for start in range(0, number_of_surrogates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+
+    if processes == 1:
+        batches = [statistic(data, make_surrogates(data, np.random.default_rng(batch_seed), number))
+                   for batch_seed, number in zip(seeds, batch_sizes)]
+    else:
+        shared = {name: share_array(array) for name, array in data.items()}
+        try:
+            descriptors = {name: descriptor for name, (_, descriptor) in shared.items()}
+            with ProcessPoolExecutor(max_workers=processes or os.cpu_count(), initializer=_attach_worker_data,
+                                     initargs=(descriptors,)) as executor:
+                batches = list(executor.map(_run_batch, [statistic] * len(seeds), [make_surrogates] * len(seeds),
+                                            seeds, batch_sizes))
+        finally:
+            for shm, _ in shared.values():
+                shm.close()
+                shm.unlink()
+
+    surrogates = np.concatenate(batches, axis=0)
+    # Add one to both counts so that a p value is never 0
+    greater = (1 + np.sum(surrogates >= observed, axis=0)) / (1 + len(surrogates))
+    less = (1 + np.sum(surrogates <= observed, axis=0)) / (1 + len(surrogates))
+
+    result = {}
+    result['observed'] = observed
+    result['surrogate_mean'] = np.nanmean(surrogates, axis=0)
+    result['p_value_greater'] = greater
+    result['p_value_less'] = less
+    result['p_value'] = np.minimum(1.0, 2 * np.minimum(greater, less))
+    result['lower'] = np.nanquantile(surrogates, (1 - confidence) / 2, axis=0)
+    result['upper'] = np.nanquantile(surrogates, (1 + confidence) / 2, axis=0)
+    return result
+
+
+def _attach_worker_data(descriptors):
+    global _worker_data, _worker_shms
+    _worker_shms = {}
+    _worker_data = {}
+    for name, descriptor in descriptors.items():
+        _worker_shms[name], _worker_data[name] = attach_array(descriptor)
+
+
+def _run_batch(statistic, make_surrogates, batch_seed, number):
+    surrogates = make_surrogates(_worker_data, np.random.default_rng(batch_seed), number)
+    return statistic(_worker_data, surrogates)
@@ -1,4 +1,13 @@
-from Autocorrelograms.utils.read_data import read_from_txt
+import numpy as np
+from Autocorrelograms.utils.lag_histogram import lag_histogram
+from Autocorrelograms.utils.read_data import load_spike_train
+from Autocorrelograms.utils.spike_train import as_spike_train
+
+# The number of samples correlated at a time by get_fft_autocorrelograms
+FFT_CHUNK_SIZE = 2 ** 20
+# The FFT method is picked when the spike pairs outnumber FFT_COST_RATIO * samples * log2(FFT length), a pair
+# costs about 8 times a sample * log2 of the FFT, so the FFT is only picked when it is clearly faster
+FFT_COST_RATIO = 0.5
 
 
 class Autocorrelograms:
@@ -9,13 +18,15 @@ class Autocorrelograms:
                  bin_size: float = 0.005,
                  whether_select: bool = False,
                  select_data_from: float = 0.0,
-                 select_data_to: float = 1.0):
+                 select_data_to: float = 1.0,
+                 method: str = 'pairwise',
+                 oversample: int = 4):
         r"""
         Calculate the coefficient of variation
 
         Parameters
         ----------
-        select_data: list
+        select_data: list or SpikeTrain
             The data used to calculate autocorrelograms vs time
         x_min: float
             Event stimulus time point left boundary, in seconds.
@@ -30,6 +41,15 @@ class Autocorrelograms:
             Start of the time range in seconds.
         select_data_to: float
             End of the time range in seconds.
+        method: str
+            'pairwise' (the default) bins the distance of every pair of spikes exactly, its time grows with the
+            number of pairs.
+            'fft' bins the train and correlates it with a real FFT, its time grows with the duration of the train
+            over bin_size, the distances are rounded to bin_size / oversample, so a count may be one bin off.
+            'auto' picks the faster one from the firing rate and the lag range, see choose_autocorrelograms_method,
+            so the result depends on the firing rate.
+        oversample: int
+            The train is binned at bin_size / oversample by the 'fft' method.
 
         References
         ----------
@@ -43,44 +63,307 @@ class Autocorrelograms:
         self.x_min = x_min
         self.x_max = x_max
         self.bin_size = bin_size
+        if method == 'auto':
+            method = choose_autocorrelograms_method(self.select_data, x_min, x_max, bin_size, oversample)
+        self.method = method
+        self.oversample = oversample
         self.bin_count = self.get_autocorrelograms()
 
     def get_autocorrelograms(self):
-        # calculate the count of bin
-        bin_count = [0 for _ in range(int((self.x_max - self.x_min) / self.bin_size))]
-        flag = 0
-        for i in range(len(self.select_data)):
-            for j in range(flag, len(self.select_data)):
-                # don't calculate the distances from this spike to itself
-                if j == i:
-                    continue
-                difference = self.select_data[j] - self.select_data[i]
-                if difference < self.x_min:
-                    flag = j
-                if difference > self.x_max:
-                    break
-                if self.x_min <= difference < self.x_max:
-                    while j < len(self.select_data) and self.x_min <= self.select_data[j] - self.select_data[i] < self.x_max:
-                        if j != i:
-                            # store the number of spike in the bin
-                            bin_count[int((self.select_data[j] - self.select_data[i] - self.x_min) / self.bin_size)] += 1
-                        j += 1
-                    break
-        return bin_count
+        r"""
+        Count the distances from every spike to every other spike that fall into [x_min, x_max).
+        The neighbours of every spike are found by binary search and all the distances are binned in chunks
+        of vectorized histograms (see lag_histogram), the distance from every spike to itself is removed after.
+
+        Returns
+        -------
+        bin_count: list, the count of distances in every bin
+        """
+        select_data = self.select_data.times
+        if self.method == 'fft':
+            return get_fft_autocorrelograms(select_data, self.x_min, self.x_max, self.bin_size,
+                                            self.oversample).tolist()
+        if self.method != 'pairwise':
+            raise ValueError(f"method has to be 'auto', 'pairwise' or 'fft', not {self.method!r}")
+        bin_count = lag_histogram(select_data, self.select_data, self.x_min, self.x_max, self.bin_size)
+        # don't calculate the distances from this spike to itself, all of them are 0 and fall into one bin
+        if self.x_min <= 0 < self.x_max:
+            self_index = int((0 - self.x_min) / self.bin_size)
+            if self_index < len(bin_count):
+                bin_count[self_index] -= len(select_data)
+        return bin_count.tolist()
+
+    @classmethod
+    def from_chunks(cls,
+                    chunks,
+                    x_min: float = -0.2,
+                    x_max: float = 0.2,
+                    bin_size: float = 0.005,
+                    whether_select: bool = False,
+                    select_data_from: float = 0.0,
+                    select_data_to: float = 1.0):
+        r"""
+        Calculate the autocorrelograms from consecutive chunks of one spike train (see iter_from_txt),
+        without materialising the whole train. Only the spikes of the previous chunk that are closer
+        than the lag range to its end are kept between chunks.
+
+        Parameters
+        ----------
+        chunks: iterable of array_like
+            Consecutive chunks of the sorted spike times in seconds.
+        x_min, x_max, bin_size, whether_select, select_data_from, select_data_to:
+            See Autocorrelograms.
+
+        Returns
+        -------
+        An Autocorrelograms whose select_data is None.
+        """
+        self = cls.__new__(cls)
+        self.whether_select = whether_select
+        self.select_data_from = select_data_from
+        self.select_data_to = select_data_to
+        self.select_data = None
+        self.x_min = x_min
+        self.x_max = x_max
+        self.bin_size = bin_size
+        self.bin_count = self._get_autocorrelograms_from_chunks(chunks)
+        return self
+
+    def _get_autocorrelograms_from_chunks(self, chunks):
+        bin_number = int((self.x_max - self.x_min) / self.bin_size)
+        bin_count = np.zeros(bin_number, dtype=np.int64)
+        # Largest distance between two spikes that can fall into a bin
+        max_lag = max(self.x_max, -self.x_min)
+        tail = np.empty(0)
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float64)
+            if self.whether_select:
+                chunk = chunk[(self.select_data_from <= chunk) & (chunk <= self.select_data_to)]
+            if not chunk.size:
+                continue
+            spikes = np.concatenate((tail, chunk))
+            new_spikes = np.arange(len(tail), len(spikes))
+            # Pair every new spike with the earlier spikes that are at most max_lag before it
+            first = np.searchsorted(spikes, spikes[new_spikes] - max_lag, side='left')
+            pair_number = new_spikes - first
+            pair_offset = np.arange(pair_number.sum()) - np.repeat(np.cumsum(pair_number) - pair_number, pair_number)
+            earlier = np.repeat(first, pair_number) + pair_offset
+            later = np.repeat(new_spikes, pair_number)
+            distance = spikes[later] - spikes[earlier]
+            # Every pair is counted from both of its spikes: once with +distance and once with -distance
+            for lags in (distance, -distance):
+                lags = lags[(self.x_min <= lags) & (lags < self.x_max)]
+                indexs = ((lags - self.x_min) / self.bin_size).astype(np.int64)
+                bin_count += np.bincount(indexs[indexs < bin_number], minlength=bin_number)
+            tail = spikes[np.searchsorted(spikes, spikes[-1] - max_lag, side='left'):]
+        return bin_count.tolist()
+
+    def coarsen(self, factor: int):
+        r"""
+        The autocorrelograms at factor times the bin size, summing every factor adjacent bins of bin_count
+        instead of pairing the spikes again.
+
+        Parameters
+        ----------
+        factor: int
+            The number of bins summed into one, it has to divide the number of bins.
+
+        Returns
+        -------
+        An Autocorrelograms with bin_size * factor, sharing select_data with this one.
+        """
+        coarse = self.__class__.__new__(self.__class__)
+        coarse.__dict__.update(self.__dict__)
+        coarse.bin_size = self.bin_size * factor
+        coarse.bin_count = coarsen_bin_count(self.bin_count, factor)
+        return coarse
 
     def draw_autocorrelograms(self):
         # Todo 画出自相关图
         pass
 
     def _preprocess_data(self, select_data):
+        select_data = as_spike_train(select_data)
         if self.whether_select:
-            select_data = [data for data in select_data if self.select_data_from <= data <= self.select_data_to]
+            select_data = select_data.time_slice(self.select_data_from, self.select_data_to)
         return select_data
 
 
+def choose_autocorrelograms_method(select_data: list,
+                                   x_min: float = -0.2,
+                                   x_max: float = 0.2,
+                                   bin_size: float = 0.005,
+                                   oversample: int = 4):
+    r"""
+    Pick the faster autocorrelogram engine: 'pairwise' costs about the number of spike pairs within the lag range,
+    n * rate * (x_max - x_min), 'fft' about the number of samples of the binned train, duration * oversample / bin_size,
+    times the log of the FFT length.
+
+    Returns
+    -------
+    method: 'pairwise' or 'fft', always 'pairwise' when x_min is not on the sample grid of the FFT
+    """
+    select_data = as_spike_train(select_data)
+    if len(select_data) < 2 or _get_min_sample(x_min, bin_size / oversample) is None:
+        return 'pairwise'
+    duration = select_data.times[-1] - select_data.times[0]
+    pair_number = len(select_data) * select_data.firing_rate * (x_max - x_min)
+    sample_number = duration * oversample / bin_size
+    if pair_number > FFT_COST_RATIO * sample_number * np.log2(FFT_CHUNK_SIZE):
+        return 'fft'
+    return 'pairwise'
+
+
+def get_fft_autocorrelograms(select_data: list,
+                             x_min: float = -0.2,
+                             x_max: float = 0.2,
+                             bin_size: float = 0.005,
+                             oversample: int = 4):
+    r"""
+    Calculate the autocorrelograms with a real FFT. The train is binned at bin_size / oversample, its autocorrelation
+    is calculated over the nonnegative lags chunk by chunk (overlap-add: every chunk is correlated with itself
+    followed by the samples of the lag range), mirrored to the negative lags, and the lags are grouped into
+    the bins [x_min + i * bin_size, x_min + (i + 1) * bin_size) of the pairwise method.
+    A lag is counted at the distance of the samples of its two spikes, which is k or k + 1 samples for a distance
+    of k + f samples (f < 1), k + 1 with probability f: the sample lag k stands for the distances within one sample
+    of k, centred on k. So a sample lag on a bin edge is split half and half between the two bins (the odd count
+    away from 0, so that the result stays symmetric), and the bins agree with the pairwise method up to the
+    counting noise, except that a step of the distances on a bin edge (e.g. a refractory period of whole bins)
+    is smeared by one sample into the other bin. The bin edges are compared in whole samples, so x_min has to be
+    a multiple of bin_size / oversample.
+
+    Parameters
+    ----------
+    select_data: list or SpikeTrain
+        The spike times in seconds.
+    x_min, x_max, bin_size:
+        See Autocorrelograms.
+    oversample: int
+        The number of samples per bin.
+
+    Returns
+    -------
+    bin_count: int array of shape (bins,)
+    """
+    bin_number = int((x_max - x_min) / bin_size)
+    sample_size = bin_size / oversample
+    # x_min in samples, the i-th bin is the lags of [min_sample + i * oversample, min_sample + (i + 1) * oversample)
+    min_sample = _get_min_sample(x_min, sample_size)
+    if min_sample is None:
+        raise ValueError(f'x_min {x_min} is not a multiple of the sample size bin_size / oversample {sample_size}')
+    spikes = as_spike_train(select_data).times
+    bin_count = np.zeros(bin_number, dtype=np.int64)
+    if not len(spikes):
+        return bin_count
+    # Largest distance, in samples, between two spikes that can fall into a bin
+    max_lag = int(np.ceil(max(x_max, -x_min) / sample_size)) + 1
+    samples = ((spikes - spikes[0]) / sample_size).astype(np.int64)
+
+    chunk_size = int(min(max(FFT_CHUNK_SIZE - max_lag, max_lag), samples[-1] + 1))
+    fft_size = 1 << (chunk_size + max_lag - 1).bit_length()
+    correlation = np.zeros(max_lag + 1)
+    chunk_start = 0
+    while chunk_start <= samples[-1]:
+        first, middle, last = np.searchsorted(samples, [chunk_start, chunk_start + chunk_size,
+                                                        chunk_start + chunk_size + max_lag + 1])
+        if middle > first:
+            chunk = np.bincount(samples[first:middle] - chunk_start, minlength=chunk_size)
+            extended = np.bincount(samples[first:last] - chunk_start, minlength=chunk_size + max_lag + 1)
+            # correlation[k] += sum_t chunk[t] * extended[t + k], no wrap around as fft_size >= chunk_size + max_lag
+            correlation += np.fft.irfft(np.conj(np.fft.rfft(chunk, fft_size)) * np.fft.rfft(extended, fft_size),
+                                        fft_size)[:max_lag + 1]
+            chunk_start += chunk_size
+        else:
+            # Skip the empty samples up to the next spike
+            chunk_start = samples[first] if first < len(samples) else samples[-1] + 1
+    correlation = np.rint(correlation).astype(np.int64)
+    # don't calculate the distances from this spike to itself
+    correlation[0] -= len(spikes)
+
+    # Mirror the nonnegative lags, the lag 0 only once
+    lag_samples = np.concatenate((-np.arange(max_lag, 0, -1), np.arange(max_lag + 1)))
+    counts = np.concatenate((correlation[:0:-1], correlation))
+    # Group the lags into the bins in whole samples, so that no lag is moved across a bin edge by rounding
+    edge_offsets = lag_samples - min_sample
+    indexs = edge_offsets // oversample
+    on_edge = edge_offsets % oversample == 0
+    upper_counts = np.where(on_edge, np.where(lag_samples >= 0, (counts + 1) // 2, counts // 2), counts)
+    # The other half of the sample lags on an edge goes to the bin below it
+    for bin_indexs, bin_counts in ((indexs, upper_counts), (indexs - 1, counts - upper_counts)):
+        inside = (0 <= bin_indexs) & (bin_indexs < bin_number)
+        bin_count += np.bincount(bin_indexs[inside], weights=bin_counts[inside],
+                                 minlength=bin_number).astype(np.int64)
+    return bin_count
+
+
+def _get_min_sample(x_min, sample_size):
+    r"""
+    Returns
+    -------
+    min_sample: x_min as an integer number of samples, None if it is not on the sample grid
+    """
+    min_sample = int(round(x_min / sample_size))
+    if not np.isclose(min_sample * sample_size, x_min, rtol=1e-9, atol=1e-12):
+        return None
+    return min_sample
+
+
+def get_autocorrelograms_pyramid(select_data: list,
+                                 x_min: float = -0.2,
+                                 x_max: float = 0.2,
+                                 bin_sizes: list = (0.001, 0.005, 0.01, 0.05),
+                                 **kwargs):
+    r"""
+    Calculate the autocorrelograms at several bin sizes from one pass over the spike pairs: the pairs are
+    binned once at the finest bin size and every coarser autocorrelogram is derived by Autocorrelograms.coarsen.
+
+    Parameters
+    ----------
+    select_data, x_min, x_max:
+        See Autocorrelograms.
+    bin_sizes: list
+        The bin sizes in seconds, each one an integer multiple of the smallest one.
+    kwargs:
+        The other options of Autocorrelograms.
+
+    Returns
+    -------
+    autocorrelograms: dict from every bin size to its Autocorrelograms
+    """
+    finest_bin_size = min(bin_sizes)
+    factors = {bin_size: get_coarsen_factor(finest_bin_size, bin_size) for bin_size in bin_sizes}
+    finest = Autocorrelograms(select_data, x_min, x_max, finest_bin_size, **kwargs)
+    return {bin_size: finest if factor == 1 else finest.coarsen(factor) for bin_size, factor in factors.items()}
+
+
+def get_coarsen_factor(bin_size: float, coarse_bin_size: float):
+    r"""
+    Returns
+    -------
+    factor: the integer number of bin_size bins in one coarse_bin_size bin, ValueError if it is not an integer
+    """
+    factor = int(round(coarse_bin_size / bin_size))
+    if factor < 1 or not np.isclose(factor * bin_size, coarse_bin_size, rtol=1e-9, atol=0):
+        raise ValueError(f'The bin size {coarse_bin_size} is not an integer multiple of {bin_size}')
+    return factor
+
+
+def coarsen_bin_count(bin_count: list, factor: int):
+    r"""
+    Returns
+    -------
+    bin_count: list of the sums of every factor adjacent bins of bin_count
+    """
+    if not isinstance(factor, (int, np.integer)) or factor < 1:
+        raise ValueError(f'The coarsen factor has to be a positive integer, not {factor!r}')
+    if len(bin_count) % factor:
+        raise ValueError(f'The coarsen factor {factor} does not divide the number of bins {len(bin_count)}')
+    return np.asarray(bin_count, dtype=np.int64).reshape(-1, factor).sum(axis=1).tolist()
+
+
 if __name__ == '__main__':
     file_name = 'datas/Neuron04a.txt'
-    datas = read_from_txt(file_name)
+    datas = load_spike_train(file_name)
     test = Autocorrelograms(datas, whether_select=True, select_data_from=0, select_data_to=10)
     test.draw_autocorrelograms()
     print()
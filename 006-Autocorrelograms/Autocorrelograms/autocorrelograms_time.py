@@ -1,5 +1,8 @@
-from Autocorrelograms.utils.read_data import read_from_txt
-from autocorrelograms import Autocorrelograms
+import numpy as np
+from Autocorrelograms.utils.lag_histogram import iter_pair_indexs
+from Autocorrelograms.utils.read_data import load_spike_train
+from Autocorrelograms.utils.result_cache import ResultCache
+from Autocorrelograms.utils.spike_train import as_spike_train
 import matplotlib.pyplot as plt
 
 
@@ -12,13 +15,14 @@ class AutocorrelogramsTime:
                  start: float = 0,
                  duration: float = 10,
                  shift: float = 1,
-                 number_of_shift: int = 20):
+                 number_of_shift: int = 20,
+                 result_cache: ResultCache = None):
         r"""
         Calculate the coefficient of variation
 
         Parameters
         ----------
-        select_data: list
+        select_data: list or SpikeTrain
             The data used to calculate autocorrelograms vs time
         x_min: float
             Event stimulus time point left boundary, in seconds.
@@ -34,13 +38,15 @@ class AutocorrelogramsTime:
             How much sliding window is shifted each time.
         number_of_shift: int
             The number of sliding windows to be used.
-
+        result_cache: ResultCache
+            If given, the autocorrelograms are loaded from this cache when they were already calculated for the
+            same spike train and parameters, and stored into it otherwise.
 
         References
         ----------
         .. [1] https://www.neuroexplorer.com/docs/reference/analysis/types/trainstruct/AutoCorrVersusTime.html
         """
-        self.select_data = select_data
+        self.select_data = as_spike_train(select_data)
         self.x_min = x_min
         self.x_max = x_max
         self.bin_size = bin_size
@@ -48,6 +54,7 @@ class AutocorrelogramsTime:
         self.duration = duration
         self.shift = shift
         self.number_of_shift = number_of_shift
+        self.result_cache = result_cache
         self.autocorrelograms_time = self._get_autocorrelograms_time()
 
     def _get_autocorrelograms_time(self):
@@ -60,17 +67,21 @@ class AutocorrelogramsTime:
         Assume result = [[n_1,...,n_i], ..., [n_1,...,n_i]], where n means the count of
         spike in this bin.
         """
-        result = []
-        for i in range(self.number_of_shift):
-            # Start_time and end_time increase depend on self.shift
-            start_time = self.start + i * self.shift
-            end_time = self.start + i * self.shift + self.duration
-            # Calculate the autocorrelogram in this bin depends on the start_time and end_time
-            autocorrelogram = Autocorrelograms(self.select_data, whether_select=True, select_data_from=start_time,
-                                               select_data_to=end_time).bin_count
-            result.append(autocorrelogram)
-
-        return result
+        if self.result_cache is not None:
+            key = self.result_cache.get_key('AutocorrelogramsTime', [self.select_data], {
+                'x_min': self.x_min, 'x_max': self.x_max, 'bin_size': self.bin_size, 'start': self.start,
+                'duration': self.duration, 'shift': self.shift, 'number_of_shift': self.number_of_shift})
+            result = self.result_cache.load(key)
+            if result is not None:
+                return result['bin_count'].tolist()
+        # Start_time and end_time increase depend on self.shift
+        start_time = self.start + np.arange(self.number_of_shift) * self.shift
+        end_time = start_time + self.duration
+        bin_count = calculate_autocorrelograms_time(self.select_data, start_time, end_time,
+                                                    self.x_min, self.x_max, self.bin_size)
+        if self.result_cache is not None:
+            self.result_cache.store(key, {'bin_count': bin_count})
+        return bin_count.tolist()
 
     def draw_autocorrelograms(self):
         r"""
@@ -84,10 +95,103 @@ class AutocorrelogramsTime:
         plt.show()
 
 
+def calculate_autocorrelograms_time(select_data: list,
+                                    start_time,
+                                    end_time,
+                                    x_min: float = -0.2,
+                                    x_max: float = 0.2,
+                                    bin_size: float = 0.005):
+    r"""
+    Calculate the autocorrelogram of the spikes in every window [start_time[w], end_time[w]] in one pass
+    over the spike pairs, whatever the number of windows and their overlap.
+
+    Every pair of spikes I < J closer than the lag range is anchored at I and counted once, with +lag and -lag.
+    With P(i) the histogram of the pairs anchored before the i-th spike, the window of the spikes [lo, hi) has
+        H = P(hi) - P(lo) - (the pairs anchored in [lo, hi) whose J >= hi),
+    P is only accumulated at the window boundaries and the last term only involves the spikes closer than
+    the lag range to the end of the window.
+
+    Parameters
+    ----------
+    select_data: list or SpikeTrain
+        The spike times in seconds.
+    start_time, end_time: array_like
+        The windows in seconds, both ends included.
+    x_min, x_max, bin_size:
+        See Autocorrelograms.
+
+    Returns
+    -------
+    bin_count: int array of shape (windows, bins), the same as Autocorrelograms(select_data, x_min, x_max, bin_size,
+    whether_select=True, select_data_from=start_time[w], select_data_to=end_time[w]).bin_count for every window w
+    """
+    bin_number = int((x_max - x_min) / bin_size)
+    spikes = as_spike_train(select_data).times
+    start_time = np.asarray(start_time, dtype=np.float64)
+    end_time = np.asarray(end_time, dtype=np.float64)
+    lo = np.searchsorted(spikes, start_time, side='left')
+    hi = np.maximum(np.searchsorted(spikes, end_time, side='right'), lo)
+    bin_count = np.zeros((len(lo), bin_number), dtype=np.int64)
+    if not len(lo) or not len(spikes):
+        return bin_count
+    # Largest distance between two spikes that can fall into a bin
+    max_lag = max(x_max, -x_min)
+    margin = 4 * np.spacing(np.abs(spikes) + max_lag)
+
+    # P at every window boundary: histogram the pairs by the segment between two boundaries their anchor falls in
+    boundaries = np.unique(np.concatenate((lo, hi)))
+    anchors = np.arange(boundaries[0], boundaries[-1])
+    last = np.searchsorted(spikes, spikes[anchors] + max_lag + margin[anchors], side='right')
+    segment_count = np.zeros((len(boundaries) + 1) * bin_number, dtype=np.int64)
+    for references, targets in iter_pair_indexs(anchors + 1, last):
+        segments = np.searchsorted(boundaries, anchors[references], side='right')
+        indexs, kept = _bin_pair_lags(spikes[targets] - spikes[anchors[references]], x_min, x_max, bin_size,
+                                      bin_number)
+        segment_count += np.bincount(segments[kept] * bin_number + indexs, minlength=len(segment_count))
+    # prefix[k] = P(boundaries[k]), the pairs anchored before the k-th boundary
+    prefix = np.cumsum(segment_count.reshape(len(boundaries) + 1, bin_number), axis=0)
+    bin_count += prefix[np.searchsorted(boundaries, hi)] - prefix[np.searchsorted(boundaries, lo)]
+
+    # Remove the pairs anchored inside a window whose J is beyond its end, only anchors within max_lag of the end
+    near = np.maximum(np.searchsorted(spikes, spikes[np.maximum(hi, 1) - 1] - max_lag - margin[np.maximum(hi, 1) - 1],
+                                      side='left'), lo)
+    near = np.minimum(near, hi)
+    windows = np.repeat(np.arange(len(lo)), hi - near)
+    boundary_anchors = (np.repeat(near - np.cumsum(hi - near) + (hi - near), hi - near)
+                        + np.arange((hi - near).sum()))
+    last = np.searchsorted(spikes, spikes[boundary_anchors] + max_lag + margin[boundary_anchors], side='right')
+    boundary_count = np.zeros(len(lo) * bin_number, dtype=np.int64)
+    for references, targets in iter_pair_indexs(hi[windows], last):
+        indexs, kept = _bin_pair_lags(spikes[targets] - spikes[boundary_anchors[references]], x_min, x_max,
+                                      bin_size, bin_number)
+        boundary_count += np.bincount(windows[references][kept] * bin_number + indexs, minlength=len(boundary_count))
+    bin_count -= boundary_count.reshape(len(lo), bin_number)
+    return bin_count
+
+
+def _bin_pair_lags(distance, x_min, x_max, bin_size, bin_number):
+    r"""
+    Every pair is counted from both of its spikes: once with +distance and once with -distance.
+
+    Returns
+    -------
+    indexs: the bins of the lags in range
+    kept: the pair of every index
+    """
+    pairs = np.arange(len(distance))
+    indexs, kept = [], []
+    for lags in (distance, -distance):
+        inside = (x_min <= lags) & (lags < x_max)
+        lag_indexs = ((lags[inside] - x_min) / bin_size).astype(np.int64)
+        inside_pairs = pairs[inside]
+        indexs.append(lag_indexs[lag_indexs < bin_number])
+        kept.append(inside_pairs[lag_indexs < bin_number])
+    return np.concatenate(indexs), np.concatenate(kept)
+
 
 if __name__ == '__main__':
     file_name = 'datas/Neuron04a.txt'
-    datas = read_from_txt(file_name)
+    datas = load_spike_train(file_name)
     test = AutocorrelogramsTime(datas)
     test.draw_autocorrelograms()
     print()
@@ -0,0 +1,200 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from Autocorrelograms.autocorrelograms import Autocorrelograms
+from Autocorrelograms.autocorrelograms_time import calculate_autocorrelograms_time
+from Autocorrelograms.utils.lag_histogram import flatten_spike_trains
+from Autocorrelograms.utils.read_data import BINARY_SUFFIX, read_from_txt
+from Autocorrelograms.utils.shared_array import attach_array, share_array
+from Autocorrelograms.utils.spike_train import SpikeTrain, as_spike_train
+
+# The shared spike trains of batch_autocorrelograms, attached once by every worker process
+_worker_data = None
+_worker_shms = None
+
+
+def batch_autocorrelograms(spike_trains,
+                           unit_names: list = None,
+                           x_min: float = -0.2,
+                           x_max: float = 0.2,
+                           bin_size: float = 0.005,
+                           start: float = None,
+                           duration: float = 10,
+                           shift: float = 1,
+                           number_of_shift: int = 20,
+                           method: str = 'pairwise',
+                           output: str = None,
+                           binary_cache: bool = False,
+                           processes: int = None,
+                           progress=None):
+    r"""
+    Calculate the autocorrelograms, or the autocorrelograms versus time, of many units across worker processes.
+    The spike trains are copied into shared memory once, every worker reads its units from there.
+
+    Parameters
+    ----------
+    spike_trains: dict or list
+        The spike trains of the units, {unit_name: select_data} or a list of them.
+        A spike train can also be given as the file it is loaded from.
+    unit_names: list
+        The names of the units when spike_trains is a list. Defaults to their index.
+    x_min, x_max, bin_size:
+        See Autocorrelograms.
+    start: float
+        If None, calculate the autocorrelograms of the whole trains (Autocorrelograms, one window).
+        Otherwise the start of the first sliding window of the autocorrelograms versus time (AutocorrelogramsTime).
+    duration, shift, number_of_shift:
+        See AutocorrelogramsTime.
+    method: str
+        See Autocorrelograms, only used for the whole trains. The sliding windows are always 'pairwise', the
+        default, so that both modes give the same counts for the same unit.
+    output: str
+        If given, every unit is written into this '.npy' file of shape (units, windows, bins) as soon as it is done,
+        and the unit names into '<output without .npy>_units.npy'.
+    binary_cache: bool
+        If True, a text file is loaded with load_spike_train, which writes a '.spk' file next to it for later loads.
+        Otherwise it is only read, nothing is written into its directory.
+    processes: int
+        The number of worker processes. Defaults to the number of cores, 1 runs in the calling process.
+    progress: callable
+        Called as progress(done, total, unit_name) in the calling process every time a unit is done.
+
+    Returns
+    -------
+    bin_count: int array of shape (units, windows, bins), memory-mapped on output if it is given
+    """
+    if isinstance(spike_trains, dict):
+        unit_names = list(spike_trains.keys())
+        spike_trains = list(spike_trains.values())
+    elif unit_names is None:
+        unit_names = [str(i) for i in range(len(spike_trains))]
+    spike_trains = [_load_unit(spike_train, binary_cache).times for spike_train in spike_trains]
+
+    if start is None:
+        window_number = 1
+        start_time, end_time = None, None
+    else:
+        window_number = number_of_shift
+        start_time = start + np.arange(number_of_shift) * shift
+        end_time = start_time + duration
+    options = (x_min, x_max, bin_size, start_time, end_time, method)
+    shape = (len(spike_trains), window_number, int((x_max - x_min) / bin_size))
+    if output is None:
+        bin_count = np.zeros(shape, dtype=np.int64)
+    else:
+        np.save(os.path.splitext(output)[0] + '_units.npy', np.asarray(unit_names, dtype=str))
+        bin_count = np.lib.format.open_memmap(output, mode='w+', dtype=np.int64, shape=shape)
+
+    data = {}
+    data['spikes'], data['offsets'] = flatten_spike_trains(spike_trains)
+    if processes == 1:
+        for index in range(len(spike_trains)):
+            bin_count[index] = _analyse_unit(data, index, *options)
+            _report(progress, index + 1, len(spike_trains), unit_names[index])
+    else:
+        shared = {name: share_array(array) for name, array in data.items()}
+        try:
+            descriptors = {name: descriptor for name, (_, descriptor) in shared.items()}
+            with ProcessPoolExecutor(max_workers=processes, initializer=_attach_worker_data,
+                                     initargs=(descriptors,)) as executor:
+                futures = {executor.submit(_run_unit, index, *options): index for index in range(len(spike_trains))}
+                for done, future in enumerate(as_completed(futures), 1):
+                    # Written and released as soon as it is done, the units are not kept in the workers or here
+                    index = futures.pop(future)
+                    bin_count[index] = future.result()
+                    _report(progress, done, len(spike_trains), unit_names[index])
+        finally:
+            for shm, _ in shared.values():
+                shm.close()
+                shm.unlink()
+
+    if output is not None:
+        bin_count.flush()
+        del bin_count
+        return np.load(output, mmap_mode='r')
+    return bin_count
+
+
+def batch_autocorrelograms_from_directory(directory: str,
+                                          pattern: str = '*.txt',
+                                          **kwargs):
+    r"""
+    Run batch_autocorrelograms on every spike train file of a directory, the unit names are the file stems.
+
+    Parameters
+    ----------
+    directory: str
+        The directory containing one file of timestamps per unit.
+    pattern: str
+        The glob pattern of the spike train files.
+    kwargs:
+        See batch_autocorrelograms.
+    """
+    file_names = sorted(glob.glob(os.path.join(directory, pattern)))
+    unit_names = [os.path.splitext(os.path.basename(file_name))[0] for file_name in file_names]
+    return batch_autocorrelograms(file_names, unit_names, **kwargs)
+
+
+def _load_unit(spike_train, binary_cache):
+    if not isinstance(spike_train, str):
+        return as_spike_train(spike_train)
+    if binary_cache or spike_train.endswith(BINARY_SUFFIX):
+        return SpikeTrain.from_file(spike_train)
+    return SpikeTrain(read_from_txt(spike_train))
+
+
+def _analyse_unit(data, index, x_min, x_max, bin_size, start_time, end_time, method):
+    r"""
+    Returns
+    -------
+    bin_count: (windows, bins) autocorrelograms of the index-th unit of the shared data
+    """
+    spikes = data['spikes'][data['offsets'][index]:data['offsets'][index + 1]]
+    if start_time is None:
+        return np.asarray([Autocorrelograms(spikes, x_min, x_max, bin_size, method=method).bin_count])
+    return calculate_autocorrelograms_time(spikes, start_time, end_time, x_min, x_max, bin_size)
+
+
+def _report(progress, done, total, unit_name):
+    if progress is not None:
+        progress(done, total, unit_name)
+
+
+def _attach_worker_data(descriptors):
+    global _worker_data, _worker_shms
+    _worker_shms = {}
+    _worker_data = {}
+    for name, descriptor in descriptors.items():
+        _worker_shms[name], _worker_data[name] = attach_array(descriptor)
+
+
+def _run_unit(index, x_min, x_max, bin_size, start_time, end_time, method):
+    return _analyse_unit(_worker_data, index, x_min, x_max, bin_size, start_time, end_time, method)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calculate the autocorrelograms of every unit in a directory')
+    parser.add_argument('directory', help='directory with one file of timestamps per unit')
+    parser.add_argument('--pattern', default='*.txt')
+    parser.add_argument('--output', default='autocorrelograms.npy', help='(units, windows, bins) result, .npy')
+    parser.add_argument('--x-min', type=float, default=-0.2)
+    parser.add_argument('--x-max', type=float, default=0.2)
+    parser.add_argument('--bin-size', type=float, default=0.005)
+    parser.add_argument('--start', type=float, default=None, help='calculate the autocorrelograms versus time')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--shift', type=float, default=1)
+    parser.add_argument('--number-of-shift', type=int, default=20)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--binary-cache', action='store_true',
+                        help='write a .spk file next to every text file, later runs memory-map it')
+    args = parser.parse_args()
+
+    batch_autocorrelograms_from_directory(args.directory, args.pattern, x_min=args.x_min, x_max=args.x_max,
+                                          bin_size=args.bin_size, start=args.start, duration=args.duration,
+                                          shift=args.shift, number_of_shift=args.number_of_shift,
+                                          output=args.output, binary_cache=args.binary_cache,
+                                          processes=args.processes,
+                                          progress=lambda done, total, unit_name: print(f'{done}/{total} {unit_name}'))
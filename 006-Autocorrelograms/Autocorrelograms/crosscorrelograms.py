@@ -0,0 +1,241 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from Autocorrelograms.utils.lag_histogram import flatten_spike_trains, lag_histogram
+from Autocorrelograms.utils.read_data import load_spike_train
+from Autocorrelograms.utils.shared_array import attach_array, share_array
+from Autocorrelograms.utils.spike_train import as_spike_train
+
+# The shared spike trains of calculate_crosscorrelograms, attached once by every worker process
+_worker_data = None
+_worker_shms = None
+
+
+class Crosscorrelograms:
+    def __init__(self,
+                 reference_data: list,
+                 target_data: list,
+                 x_min: float = -0.2,
+                 x_max: float = 0.2,
+                 bin_size: float = 0.005,
+                 event_data: list = None,
+                 trial_from: float = -1.0,
+                 trial_to: float = 1.0):
+        r"""
+        Calculate the crosscorrelograms of two spike trains: the distribution of the lags
+        (target spike - reference spike) in [x_min, x_max).
+
+        Parameters
+        ----------
+        reference_data: list or SpikeTrain
+            The spike times of the reference neuron in seconds.
+        target_data: list or SpikeTrain
+            The spike times of the target neuron in seconds.
+        x_min: float
+            Left boundary of the lags, in seconds.
+        x_max: float
+            Right boundary of the lags, in seconds.
+        bin_size: float
+            Bin size in seconds
+        event_data: list
+            If given, the reference events of the trials (e.g. the reference_data of the JPSTH), and the
+            shift predictor is calculated too. Only the spikes in [event + trial_from, event + trial_to] of every
+            trial are used, and the shift predictor pairs the reference spikes of trial k with the target spikes
+            of trial k + 1 (the last trial with the first one).
+        trial_from: float
+            Start of the trials relative to their events, in seconds.
+        trial_to: float
+            End of the trials relative to their events, in seconds.
+
+        References
+        ----------
+        .. [1] https://www.neuroexplorer.com/docs/reference/analysis/types/trainstruct/Crosscorrelograms.html
+        """
+        self.reference_data = as_spike_train(reference_data)
+        self.target_data = as_spike_train(target_data)
+        self.x_min = x_min
+        self.x_max = x_max
+        self.bin_size = bin_size
+        self.event_data = event_data
+        self.trial_from = trial_from
+        self.trial_to = trial_to
+
+        if event_data is None:
+            self.bin_count = lag_histogram(self.reference_data, self.target_data, x_min, x_max, bin_size).tolist()
+            self.shift_predictor = None
+            self.corrected_bin_count = None
+        else:
+            trial_period = _get_trial_period(x_min, x_max, trial_from, trial_to)
+            reference_trials = get_trial_times(self.reference_data, event_data, trial_period, trial_from, trial_to)
+            target_trials = get_trial_times(self.target_data, event_data, trial_period, trial_from, trial_to)
+            shifted_target_trials = get_trial_times(self.target_data, event_data, trial_period, trial_from, trial_to,
+                                                    shift=1)
+            bin_count = lag_histogram(reference_trials, target_trials, x_min, x_max, bin_size)
+            shift_predictor = lag_histogram(reference_trials, shifted_target_trials, x_min, x_max, bin_size)
+            self.bin_count = bin_count.tolist()
+            self.shift_predictor = shift_predictor.tolist()
+            self.corrected_bin_count = (bin_count - shift_predictor).tolist()
+
+
+def calculate_crosscorrelograms(spike_trains: list,
+                                pairs=None,
+                                x_min: float = -0.2,
+                                x_max: float = 0.2,
+                                bin_size: float = 0.005,
+                                event_data: list = None,
+                                trial_from: float = -1.0,
+                                trial_to: float = 1.0,
+                                processes: int = None):
+    r"""
+    Calculate the crosscorrelograms of many pairs of spike trains across worker processes.
+    The spike trains are copied into shared memory once, every worker reads them from there.
+
+    Parameters
+    ----------
+    spike_trains: list
+        The spike trains of the N neurons, lists or SpikeTrains.
+    pairs: array_like
+        (P, 2) array of neuron indexes (i, j), the crosscorrelogram of a pair is the one of
+        Crosscorrelograms(spike_trains[i], spike_trains[j]). Defaults to every pair i < j.
+    x_min, x_max, bin_size, event_data, trial_from, trial_to:
+        See Crosscorrelograms.
+    processes: int
+        The number of worker processes, defaults to the number of CPUs. 1 runs everything in this process.
+
+    Returns
+    -------
+    result: dict with
+        'pairs', the (P, 2) pairs,
+        'bin_count', the (P, bins) crosscorrelograms,
+        and, if event_data is given, 'shift_predictor' and 'corrected_bin_count' of the same shape.
+    """
+    spike_trains = [as_spike_train(spike_train).times for spike_train in spike_trains]
+    if pairs is None:
+        pairs = np.stack(np.triu_indices(len(spike_trains), 1), axis=1)
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+
+    data = {}
+    if event_data is None:
+        data['spikes'], data['offsets'] = flatten_spike_trains(spike_trains)
+    else:
+        trial_period = _get_trial_period(x_min, x_max, trial_from, trial_to)
+        data['spikes'], data['offsets'] = flatten_spike_trains(
+            [get_trial_times(spike_train, event_data, trial_period, trial_from, trial_to)
+             for spike_train in spike_trains])
+        data['shifted_spikes'], data['shifted_offsets'] = flatten_spike_trains(
+            [get_trial_times(spike_train, event_data, trial_period, trial_from, trial_to, shift=1)
+             for spike_train in spike_trains])
+
+    processes = processes or os.cpu_count()
+    batch_size = max(1, -(-len(pairs) // (4 * processes)))
+    batches = [pairs[start:start + batch_size] for start in range(0, len(pairs), batch_size)]
+    if processes == 1:
+        results = [_calculate_pairs(data, batch, x_min, x_max, bin_size) for batch in batches]
+    else:
+        shared = {name: share_array(array) for name, array in data.items()}
+        try:
+            descriptors = {name: descriptor for name, (_, descriptor) in shared.items()}
+            with ProcessPoolExecutor(max_workers=processes, initializer=_attach_worker_data,
+                                     initargs=(descriptors,)) as executor:
+                results = list(executor.map(_run_pairs, batches, [x_min] * len(batches), [x_max] * len(batches),
+                                            [bin_size] * len(batches)))
+        finally:
+            for shm, _ in shared.values():
+                shm.close()
+                shm.unlink()
+
+    bin_number = int((x_max - x_min) / bin_size)
+    bin_count = np.concatenate([bin_counts for bin_counts, _ in results] or [np.empty((0, bin_number), np.int64)])
+    result = {'pairs': pairs, 'bin_count': bin_count}
+    if event_data is not None:
+        shift_predictor = np.concatenate([shift_predictors for _, shift_predictors in results]
+                                         or [np.empty((0, bin_number), np.int64)])
+        result['shift_predictor'] = shift_predictor
+        result['corrected_bin_count'] = bin_count - shift_predictor
+    return result
+
+
+def get_trial_times(spike_train: list,
+                    event_data: list,
+                    trial_period: float,
+                    trial_from: float = -1.0,
+                    trial_to: float = 1.0,
+                    shift: int = 0):
+    r"""
+    Lay the trials of a spike train one after the other on a virtual time axis: the spikes of the k-th trial
+    are placed at k * trial_period plus their time relative to their event. With trial_period larger than the
+    trial plus the lag range, the lags between the spikes of different trials are out of the lag range,
+    so that one lag_histogram of two such trains only counts the pairs inside every trial.
+
+    Parameters
+    ----------
+    spike_train: list or SpikeTrain
+        The spike times in seconds.
+    event_data: list
+        The reference events of the trials in seconds.
+    trial_period: float
+        The distance between two trials on the virtual time axis, see _get_trial_period.
+    trial_from, trial_to:
+        See Crosscorrelograms.
+    shift: int
+        The k-th trial is filled with the spikes of the (k + shift)-th trial (circularly), e.g. 1 for the
+        shift predictor.
+
+    Returns
+    -------
+    trial_times: sorted float64 array of the virtual spike times
+    """
+    spike_train = as_spike_train(spike_train).times
+    event_data = np.asarray(event_data, dtype=np.float64)
+    source_events = np.roll(event_data, -shift)
+    first = np.searchsorted(spike_train, source_events + trial_from, side='left')
+    last = np.searchsorted(spike_train, source_events + trial_to, side='right')
+    counts = last - first
+    trials = np.repeat(np.arange(len(event_data)), counts)
+    spikes = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return (spike_train[spikes] - source_events[trials]) + trials * trial_period
+
+
+def _get_trial_period(x_min, x_max, trial_from, trial_to):
+    # Two spikes of different trials are at least trial_period - (trial_to - trial_from) apart
+    return (trial_to - trial_from) + 2 * max(abs(x_min), abs(x_max))
+
+
+def _calculate_pairs(data, pairs, x_min, x_max, bin_size):
+    spikes, offsets = data['spikes'], data['offsets']
+    bin_counts = np.stack([lag_histogram(spikes[offsets[i]:offsets[i + 1]], spikes[offsets[j]:offsets[j + 1]],
+                                         x_min, x_max, bin_size) for i, j in pairs])
+    if 'shifted_spikes' not in data:
+        return bin_counts, None
+    shifted_spikes, shifted_offsets = data['shifted_spikes'], data['shifted_offsets']
+    shift_predictors = np.stack([lag_histogram(spikes[offsets[i]:offsets[i + 1]],
+                                               shifted_spikes[shifted_offsets[j]:shifted_offsets[j + 1]],
+                                               x_min, x_max, bin_size) for i, j in pairs])
+    return bin_counts, shift_predictors
+
+
+def _attach_worker_data(descriptors):
+    global _worker_data, _worker_shms
+    _worker_shms = {}
+    _worker_data = {}
+    for name, descriptor in descriptors.items():
+        _worker_shms[name], _worker_data[name] = attach_array(descriptor)
+
+
+def _run_pairs(pairs, x_min, x_max, bin_size):
+    return _calculate_pairs(_worker_data, pairs, x_min, x_max, bin_size)
+
+
+if __name__ == '__main__':
+    # The events and the second neuron are only shipped with the JPSTH package
+    jpsth_datas = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '005-JPSTH', 'JPSTH', 'datas')
+    reference_name = os.path.join(jpsth_datas, 'Event04.txt')
+    neuron_names = [os.path.join(jpsth_datas, 'Neuron04a.txt'), os.path.join(jpsth_datas, 'Neuron05b.txt')]
+
+    events = load_spike_train(reference_name)
+    neurons = [load_spike_train(neuron_name) for neuron_name in neuron_names]
+
+    test = Crosscorrelograms(neurons[0], neurons[1], event_data=events)
+    print(test.corrected_bin_count)
+    print(calculate_crosscorrelograms(neurons, event_data=events)['corrected_bin_count'])
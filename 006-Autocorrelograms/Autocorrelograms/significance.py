@@ -0,0 +1,109 @@
+from functools import partial
+
+import numpy as np
+from Autocorrelograms.utils.lag_histogram import iter_pair_indexs
+from Autocorrelograms.utils.read_data import load_spike_train
+from Autocorrelograms.utils.surrogate import jitter_spikes, shuffle_isis, surrogate_test
+
+# The number of spike pairs binned at a time by _autocorrelograms_statistic, small enough to stay in the cache
+SURROGATE_BLOCK_SIZE = 2 ** 15
+
+
+def autocorrelograms_significance(select_data: list,
+                                  x_min: float = -0.2,
+                                  x_max: float = 0.2,
+                                  bin_size: float = 0.005,
+                                  method: str = 'ISI shuffling',
+                                  jitter: float = 0.005,
+                                  number_of_surrogates: int = 1000,
+                                  batch_size: int = 50,
+                                  processes: int = None,
+                                  seed: int = None,
+                                  confidence: float = 0.95):
+    r"""
+    Test every bin of the autocorrelograms against surrogate spike trains.
+
+    Parameters
+    ----------
+    select_data, x_min, x_max, bin_size:
+        See Autocorrelograms.
+    method: str
+        'ISI shuffling' keeps the ISI distribution and destroys the order of the ISIs,
+        'Spike jitter' moves every spike uniformly within [-jitter, jitter].
+    jitter: float
+        The jitter in seconds, for 'Spike jitter'.
+    number_of_surrogates, batch_size, processes, seed, confidence:
+        See surrogate_test.
+
+    Returns
+    -------
+    result: dict of surrogate_test, every statistic is a bin_count of shape (bins,)
+    """
+    data = {'select_data': np.asarray(select_data, dtype=np.float64)}
+    statistic = partial(_autocorrelograms_statistic, x_min=x_min, x_max=x_max, bin_size=bin_size)
+    if method == 'ISI shuffling':
+        make_surrogates = _shuffle_isis_surrogates
+    elif method == 'Spike jitter':
+        make_surrogates = partial(_jitter_surrogates, jitter=jitter)
+    else:
+        raise ValueError(f'Unknown surrogate method {method}')
+
+    observed = statistic(data, data['select_data'][None])[0]
+    return surrogate_test(statistic, make_surrogates, data, observed, number_of_surrogates,
+                          batch_size, processes, seed, confidence)
+
+
+def _autocorrelograms_statistic(data, surrogates, x_min, x_max, bin_size):
+    r"""
+    The same as Autocorrelograms(surrogate, x_min, x_max, bin_size).bin_count, for every row of surrogates at once.
+    The rows are laid one after the other on a virtual time axis (like get_trial_times of crosscorrelograms), far
+    enough apart that one binary search only finds the later neighbours of every spike within its own row.
+    The distances are taken from the real spike times and binned as +distance and -distance into one bincount,
+    every row into its own bins.
+
+    Returns
+    -------
+    bin_count: int array of shape (surrogates, bins)
+    """
+    surrogates = np.asarray(surrogates, dtype=np.float64)
+    number, spike_number = surrogates.shape
+    bin_number = int((x_max - x_min) / bin_size)
+    bin_count = np.zeros(number * bin_number, dtype=np.int64)
+    if not surrogates.size:
+        return bin_count.reshape(number, bin_number)
+    # Largest distance between two spikes that can fall into a bin
+    max_lag = max(x_max, -x_min)
+    spikes = surrogates.ravel()
+    rows = np.repeat(np.arange(number), spike_number)
+    # Two spikes of different rows are at least max_lag + 1 apart on the virtual axis
+    period = (spikes.max() - spikes.min()) + max_lag + 1
+    virtual = (spikes - spikes.min()) + rows * period
+
+    # Search slightly wider ranges, the distances are compared with x_min and x_max exactly below
+    margin = 4 * np.spacing(virtual + max_lag)
+    last = np.searchsorted(virtual, virtual + max_lag + margin, side='right')
+    for references, targets in iter_pair_indexs(np.arange(1, len(spikes) + 1), last, SURROGATE_BLOCK_SIZE):
+        distance = spikes[targets] - spikes[references]
+        row_offsets = rows[references] * bin_number
+        # Every pair is counted from both of its spikes: once with +distance and once with -distance
+        for lags in (distance, -distance):
+            # All the pairs are indexed first, so that only one selection is needed
+            indexs = ((lags - x_min) / bin_size).astype(np.int64)
+            kept = (x_min <= lags) & (lags < x_max) & (indexs < bin_number)
+            bin_count += np.bincount((indexs + row_offsets)[kept], minlength=len(bin_count))
+    return bin_count.reshape(number, bin_number)
+
+
+def _shuffle_isis_surrogates(data, rng, number):
+    return shuffle_isis(data['select_data'], rng, number)
+
+
+def _jitter_surrogates(data, rng, number, jitter):
+    return jitter_spikes(data['select_data'], rng, number, jitter)
+
+
+if __name__ == '__main__':
+    file_name = 'datas/Neuron04a.txt'
+    datas = load_spike_train(file_name)
+    significance = autocorrelograms_significance(datas, number_of_surrogates=200, seed=0)
+    print(significance['p_value'])
@@ -0,0 +1,95 @@
+import numpy as np
+
+from Autocorrelograms.utils.spike_train import as_spike_train
+
+# The number of spike pairs histogrammed at a time by lag_histogram
+LAG_BLOCK_SIZE = 2 ** 22
+
+
+def lag_histogram(reference_data: list,
+                  target_data: list,
+                  x_min: float = -0.2,
+                  x_max: float = 0.2,
+                  bin_size: float = 0.005):
+    r"""
+    Count the lags (target spike - reference spike) of every pair of a reference spike and a target spike
+    that fall into [x_min, x_max), in bins of bin_size.
+
+    The target spikes within the lag range of every reference spike are found by binary search, and the lags
+    of all the pairs are binned in one vectorized histogram, about LAG_BLOCK_SIZE pairs at a time.
+
+    Parameters
+    ----------
+    reference_data: list or SpikeTrain
+        The reference spike times in seconds, they do not have to be sorted.
+    target_data: list or SpikeTrain
+        The target spike times in seconds.
+    x_min: float
+        Left boundary of the lags, in seconds.
+    x_max: float
+        Right boundary of the lags (excluded), in seconds.
+    bin_size: float
+        Bin size in seconds.
+
+    Returns
+    -------
+    bin_count: int array of shape (bins,), bin_count[i] is the number of pairs whose lag falls into the i-th bin
+    """
+    bin_number = int((x_max - x_min) / bin_size)
+    reference_data = np.asarray(reference_data, dtype=np.float64)
+    target_data = as_spike_train(target_data).times
+    bin_count = np.zeros(bin_number, dtype=np.int64)
+    if not len(reference_data) or not len(target_data):
+        return bin_count
+
+    # Search slightly wider ranges, the lags are compared with x_min and x_max exactly below
+    margin = 4 * np.spacing(np.abs(reference_data) + max(abs(x_min), abs(x_max)))
+    first = np.searchsorted(target_data, reference_data + x_min - margin, side='left')
+    last = np.searchsorted(target_data, reference_data + x_max + margin, side='right')
+    # Histogram the reference spikes in blocks, so that the lags of about LAG_BLOCK_SIZE pairs are held at a time
+    for references, targets in iter_pair_indexs(first, last):
+        lags = target_data[targets] - reference_data[references]
+        lags = lags[(x_min <= lags) & (lags < x_max)]
+        indexs = ((lags - x_min) / bin_size).astype(np.int64)
+        bin_count += np.bincount(indexs[indexs < bin_number], minlength=bin_number)
+    return bin_count
+
+
+def iter_pair_indexs(first, last, block_size: int = None):
+    r"""
+    Enumerate the pairs (i, j) for every i and every j in [first[i], last[i]), in blocks of about
+    block_size pairs (LAG_BLOCK_SIZE by default), so that the memory stays bounded.
+
+    Yields
+    ------
+    references, targets: int arrays of the i and the j of the pairs of one block
+    """
+    block_size = block_size or LAG_BLOCK_SIZE
+    counts = np.maximum(last - first, 0)
+    cumulative_counts = np.cumsum(counts)
+    block_start = 0
+    while block_start < len(first):
+        block_end = int(np.searchsorted(cumulative_counts, cumulative_counts[block_start] - counts[block_start]
+                                        + block_size, side='right'))
+        block_end = max(block_end, block_start + 1)
+        block_counts = counts[block_start:block_end]
+        references = np.repeat(np.arange(block_start, block_end), block_counts)
+        targets = (np.repeat(first[block_start:block_end] - np.cumsum(block_counts) + block_counts, block_counts)
+                   + np.arange(block_counts.sum()))
+        yield references, targets
+        block_start = block_end
+
+
+def flatten_spike_trains(spike_trains):
+    r"""
+    Concatenate spike trains into one array, e.g. to place them in shared memory at once.
+
+    Returns
+    -------
+    spikes: all the spike trains concatenated
+    offsets: the i-th spike train is spikes[offsets[i]:offsets[i + 1]]
+    """
+    offsets = np.zeros(len(spike_trains) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(spike_train) for spike_train in spike_trains])
+    spikes = np.concatenate(spike_trains) if spike_trains else np.empty(0)
+    return np.asarray(spikes, dtype=np.float64), offsets
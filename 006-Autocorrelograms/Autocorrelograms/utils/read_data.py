@@ -1,3 +1,19 @@
+import json
+import os
+import struct
+import tempfile
+from itertools import islice
+
+import numpy as np
+
+# Layout of the binary spike train file:
+#   magic (8 bytes) | header length (uint32, little endian) | JSON header | padding | float64 timestamps
+# The timestamps start on a 64 bytes boundary so that they can be memory-mapped directly.
+BINARY_MAGIC = b'SPKTRN01'
+BINARY_SUFFIX = '.spk'
+BINARY_ALIGNMENT = 64
+
+
 def read_from_txt(file_name: str):
     with open(file_name, 'r') as file:
         lines = file.readlines()
@@ -6,6 +22,213 @@ def read_from_txt(file_name: str):
     return data
 
 
+def iter_from_txt(file_name: str,
+                  chunk_size: int = 65536,
+                  time_min: float = None,
+                  time_max: float = None,
+                  include_next: bool = False):
+    r"""
+    Read a text file of timestamps (one per line) chunk by chunk, so that the whole file never has to be
+    held in memory.
+
+    Parameters
+    ----------
+    file_name: str
+        The text file to be read.
+    chunk_size: int
+        The number of lines parsed at a time.
+    time_min: float
+        If given, the timestamps smaller than time_min are dropped.
+    time_max: float
+        If given, the timestamps larger than time_max are dropped and, as the timestamps are sorted,
+        reading stops at the first one of them.
+    include_next: bool
+        If True, the first timestamp larger than time_max is yielded too, e.g. for get_cv2_from_chunks,
+        as the last ISI before time_max ends there.
+
+    Yields
+    ------
+    chunk: float64 array with at most chunk_size timestamps
+    """
+    with open(file_name, 'r') as file:
+        while True:
+            lines = list(islice(file, chunk_size))
+            if not lines:
+                return
+            chunk = np.loadtxt(lines, dtype=np.float64, ndmin=1)
+            if time_min is not None and chunk.size and chunk[-1] < time_min:
+                continue
+            if time_min is not None:
+                chunk = chunk[chunk >= time_min]
+            if time_max is not None and chunk.size and chunk[-1] > time_max:
+                # The rest of the file is beyond time_max, stop reading here
+                chunk = chunk[:np.searchsorted(chunk, time_max, side='right') + include_next]
+                if chunk.size:
+                    yield chunk
+                return
+            if chunk.size:
+                yield chunk
+
+
+def convert_txt_to_binary(file_name: str,
+                          binary_name: str = None,
+                          unit_name: str = None,
+                          chunk_size: int = 65536):
+    r"""
+    Convert a text file of timestamps (one per line) into the binary spike train format.
+    The text is parsed chunk by chunk, so files larger than memory can be converted.
+
+    Parameters
+    ----------
+    file_name: str
+        The text file to be converted.
+    binary_name: str
+        The binary file to be written. Defaults to file_name with the suffix replaced by '.spk'.
+    unit_name: str
+        The name of the unit stored in the header. Defaults to the stem of file_name.
+    chunk_size: int
+        The number of lines parsed at a time.
+
+    Returns
+    -------
+    binary_name: the path of the written binary file
+    """
+    if binary_name is None:
+        binary_name = os.path.splitext(file_name)[0] + BINARY_SUFFIX
+    if unit_name is None:
+        unit_name = os.path.splitext(os.path.basename(file_name))[0]
+
+    write_binary(binary_name, iter_from_txt(file_name, chunk_size), unit_name)
+    return binary_name
+
+
+def write_binary(binary_name: str, data, unit_name: str = ''):
+    r"""
+    Write timestamps into the binary spike train format.
+
+    Parameters
+    ----------
+    binary_name: str
+        The binary file to be written.
+    data: array_like or iterable of array_like
+        The timestamps in seconds, either as one array or as consecutive chunks.
+    unit_name: str
+        The name of the unit stored in the header.
+    """
+    if isinstance(data, (np.ndarray, list, tuple)):
+        data = [data]
+
+    # The header is only known after all chunks are written, so reserve room for the longest possible one
+    longest_header = _binary_header_bytes(unit_name, 2 ** 63 - 1, False,
+                                          -np.finfo(np.float64).max, -np.finfo(np.float64).max)
+    offset = len(BINARY_MAGIC) + 4 + len(longest_header)
+    header_length = len(longest_header) + -offset % BINARY_ALIGNMENT
+
+    count, is_sorted, time_min, time_max, last = 0, True, None, None, None
+    # Write to a unique temporary file first, so that a reader never sees a half written file and two processes
+    # converting the same file do not write into each other's
+    handle, temp_name = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(binary_name)))
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            file.seek(len(BINARY_MAGIC) + 4 + header_length)
+            for chunk in data:
+                chunk = np.ascontiguousarray(chunk, dtype='<f8')
+                if not chunk.size:
+                    continue
+                is_sorted = is_sorted and bool(np.all(chunk[1:] >= chunk[:-1])) and (last is None or chunk[0] >= last)
+                time_min = float(chunk.min()) if time_min is None else min(time_min, float(chunk.min()))
+                time_max = float(chunk.max()) if time_max is None else max(time_max, float(chunk.max()))
+                count += chunk.size
+                last = chunk[-1]
+                chunk.tofile(file)
+
+            header = _binary_header_bytes(unit_name, count, is_sorted, time_min, time_max)
+            file.seek(0)
+            file.write(BINARY_MAGIC)
+            file.write(struct.pack('<I', header_length))
+            file.write(header.ljust(header_length))
+        # mkstemp creates the file readable by its owner only, give it the mode open() would have
+        os.chmod(temp_name, 0o666 & ~_get_umask())
+        os.replace(temp_name, binary_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def _get_umask():
+    # The umask can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _binary_header_bytes(unit_name, count, is_sorted, time_min, time_max):
+    header = {
+        'unit_name': unit_name,
+        'count': int(count),
+        'is_sorted': bool(is_sorted),
+        'time_min': time_min,
+        'time_max': time_max,
+    }
+    return json.dumps(header).encode('utf-8')
+
+
+def read_binary_header(binary_name: str):
+    r"""
+    Returns
+    -------
+    header: dict with the unit name, count, is_sorted, time_min and time_max of the binary file
+    offset: the byte offset of the first timestamp
+    """
+    with open(binary_name, 'rb') as file:
+        magic = file.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            raise ValueError(f'{binary_name} is not a binary spike train file')
+        header_length, = struct.unpack('<I', file.read(4))
+        header = json.loads(file.read(header_length).decode('utf-8'))
+    return header, len(BINARY_MAGIC) + 4 + header_length
+
+
+def read_from_binary(binary_name: str):
+    r"""
+    Memory-map the timestamps of a binary spike train file.
+
+    Returns
+    -------
+    data: read-only float64 array viewing the file, no data is copied
+    """
+    header, offset = read_binary_header(binary_name)
+    if header['count'] == 0:
+        return np.empty(0, dtype=np.float64)
+    data = np.memmap(binary_name, dtype='<f8', mode='r', offset=offset, shape=(header['count'],))
+    return data.view(np.ndarray)
+
+
+def load_spike_train(file_name: str):
+    r"""
+    Load the timestamps of one unit. A text file is converted once into a '.spk' file next to it,
+    later loads memory-map that file instead of parsing the text again.
+
+    Parameters
+    ----------
+    file_name: str
+        A text file of timestamps or a binary '.spk' file.
+
+    Returns
+    -------
+    data: read-only float64 array of the timestamps in seconds
+    """
+    if file_name.endswith(BINARY_SUFFIX):
+        return read_from_binary(file_name)
+
+    binary_name = os.path.splitext(file_name)[0] + BINARY_SUFFIX
+    if not os.path.exists(binary_name) or os.path.getmtime(binary_name) < os.path.getmtime(file_name):
+        convert_txt_to_binary(file_name, binary_name)
+    return read_from_binary(binary_name)
+
+
 if __name__ == '__main__':
     file_name = '../datas/Neuron04a.txt'
-    print(read_from_txt(file_name))
\ No newline at end of file
+    print(read_from_txt(file_name))
+    print(load_spike_train(file_name))
@@ -0,0 +1,34 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def share_array(array):
+    r"""
+    Copy an array into a new block of shared memory, so that worker processes can read it without pickling.
+
+    Returns
+    -------
+    shm: the SharedMemory, the caller has to close() and unlink() it once the workers are done
+    descriptor: (name, shape, dtype) to be given to attach_array in the workers
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(descriptor):
+    r"""
+    Attach to an array shared by share_array, no data is copied.
+
+    Returns
+    -------
+    shm: the SharedMemory, it has to stay referenced as long as the array is used
+    array: read-only view of the shared array
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
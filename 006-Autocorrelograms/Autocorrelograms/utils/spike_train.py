@@ -0,0 +1,146 @@
+import hashlib
+import os
+
+import numpy as np
+from Autocorrelograms.utils.read_data import BINARY_SUFFIX, load_spike_train, read_binary_header
+
+# The number of time range slices kept by every SpikeTrain
+SLICE_CACHE_SIZE = 128
+
+
+class SpikeTrain:
+    __slots__ = ('times', 'name', '_isis', '_firing_rate', '_slices', '_digest')
+
+    def __init__(self,
+                 times,
+                 name: str = '',
+                 assume_sorted: bool = False):
+        r"""
+        The spike times of one unit, backed by a contiguous float64 array that is always sorted.
+        A SpikeTrain can be used wherever a list of spike times is accepted, and the derived quantities
+        (ISIs, firing rate, time range slices) are computed once and cached.
+
+        Parameters
+        ----------
+        times: array_like
+            The spike times in seconds. A contiguous float64 array (e.g. of load_spike_train) is not copied.
+        name: str
+            The name of the unit.
+        assume_sorted: bool
+            If True, times is known to be sorted and is not checked.
+        """
+        times = np.ascontiguousarray(times, dtype=np.float64)
+        if times.ndim != 1:
+            raise ValueError('The spike times have to be one dimensional')
+        if not assume_sorted and np.any(times[1:] < times[:-1]):
+            times = np.sort(times)
+        self.times = times
+        self.name = name
+        self._isis = None
+        self._firing_rate = None
+        self._slices = {}
+        self._digest = None
+
+    @classmethod
+    def from_file(cls, file_name: str):
+        r"""
+        Load a SpikeTrain with load_spike_train, the name and the sortedness come from the binary header.
+        """
+        times = load_spike_train(file_name)
+        binary_name = file_name if file_name.endswith(BINARY_SUFFIX) else os.path.splitext(file_name)[0] + BINARY_SUFFIX
+        header, _ = read_binary_header(binary_name)
+        return cls(times, header['unit_name'], assume_sorted=header['is_sorted'])
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        return self.times[index]
+
+    def __iter__(self):
+        return iter(self.times)
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None or np.dtype(dtype) == self.times.dtype:
+            return self.times.copy() if copy else self.times
+        return self.times.astype(dtype)
+
+    @property
+    def isis(self):
+        r"""
+        The interspike intervals, isis[i] = times[i + 1] - times[i].
+        """
+        if self._isis is None:
+            self._isis = np.diff(self.times)
+        return self._isis
+
+    @property
+    def firing_rate(self):
+        r"""
+        The mean firing rate in Hz between the first and the last spike.
+        """
+        if self._firing_rate is None:
+            duration = self.times[-1] - self.times[0] if len(self.times) > 1 else 0.0
+            self._firing_rate = (len(self.times) - 1) / duration if duration > 0 else np.nan
+        return self._firing_rate
+
+    @property
+    def digest(self):
+        r"""
+        A hash of the spike times, equal for SpikeTrains with the same times. Used as a cache key.
+        """
+        if self._digest is None:
+            self._digest = array_digest(self.times)
+        return self._digest
+
+    def index_range(self, time_min: float, time_max: float):
+        r"""
+        Returns
+        -------
+        first, last: the spikes in [time_min, time_max] are times[first:last], found by binary search
+        """
+        first = int(np.searchsorted(self.times, time_min, side='left'))
+        last = int(np.searchsorted(self.times, time_max, side='right'))
+        return first, max(first, last)
+
+    def time_slice(self, time_min: float, time_max: float):
+        r"""
+        Returns
+        -------
+        spike_train: SpikeTrain of the spikes in [time_min, time_max], a view of this one without copying data
+        """
+        key = (time_min, time_max)
+        spike_train = self._slices.get(key)
+        if spike_train is None:
+            first, last = self.index_range(time_min, time_max)
+            spike_train = SpikeTrain(self.times[first:last], self.name, assume_sorted=True)
+            if self._isis is not None:
+                spike_train._isis = self._isis[first:max(first, last - 1)]
+            if len(self._slices) >= SLICE_CACHE_SIZE:
+                self._slices.pop(next(iter(self._slices)))
+            self._slices[key] = spike_train
+        return spike_train
+
+
+def as_spike_train(spike_train):
+    r"""
+    Returns
+    -------
+    spike_train: the argument itself if it is a SpikeTrain, otherwise a new SpikeTrain of it
+    """
+    if isinstance(spike_train, SpikeTrain):
+        return spike_train
+    return SpikeTrain(spike_train)
+
+
+def array_digest(array):
+    r"""
+    Returns
+    -------
+    digest: hex string hashing the dtype, the shape and the content of an array
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{array.dtype.str}{array.shape}'.encode())
+    digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
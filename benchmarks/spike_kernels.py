@@ -0,0 +1,244 @@
+r"""
+Benchmark of the spike analysis kernels of 004-CV2, 005-JPSTH and 006-Autocorrelograms on synthetic data.
+
+Every kernel is timed and memory-profiled over a grid of spike counts, trial counts and bin sizes, the report is
+written as JSON and compared against a stored baseline. Run from the repository root, e.g.
+
+    python benchmarks/spike_kernels.py --spikes 10000 100000 --trials 100 1000 --bin-sizes 0.01 0.005 \
+        --output report.json --baseline benchmarks/baseline.json
+
+benchmarks/baseline.json is a report of the default grid. Timings only compare on the same machine, so record
+a baseline of your own before changing a kernel, with the same grid as the later runs:
+
+    python benchmarks/spike_kernels.py --save-baseline my_baseline.json
+
+--check-fft also compares the FFT and the pairwise autocorrelograms (see check_fft_autocorrelograms).
+The exit status is 1 when a kernel got slower than the baseline by more than the tolerance, or when the checked
+FFT and pairwise autocorrelograms disagree.
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for project in ('004-CV2', '005-JPSTH', '006-Autocorrelograms'):
+    sys.path.insert(0, os.path.join(REPOSITORY, project))
+
+from CV2.cv2 import get_cv2
+from CV2.utils.signal_generator import generate_poisson_trains
+from JPSTH.jpsth import JointPeriStimulusTimeHistogram
+from JPSTH.psth import calculate_psth
+from Autocorrelograms.autocorrelograms import Autocorrelograms, get_fft_autocorrelograms
+from Autocorrelograms.autocorrelograms_time import AutocorrelogramsTime
+from Autocorrelograms.utils.read_data import read_from_txt
+
+# Firing rate of the synthetic trains, the duration of a session follows from the number of spikes
+FIRING_RATE = 20.0
+
+
+def run_cv2(case):
+    get_cv2(case['select_data'], time_min=0, time_max=case['duration'])
+
+
+def run_psth(case):
+    calculate_psth(case['reference_data'], case['select_data'], bin_size=case['bin_size'])
+
+
+def run_jpsth(case):
+    # Without the PSTH cache, otherwise every run after the first would only measure cache hits
+    JointPeriStimulusTimeHistogram(case['reference_data'], case['select_data'], case['bottom_data'],
+                                   bin_size=case['bin_size'], normalization='(JPSTH-PSTHpred)/SDpred',
+                                   cache=None).get_processed_jpsth()
+
+
+def run_autocorrelograms(case):
+    Autocorrelograms(case['select_data'], bin_size=case['bin_size'])
+
+
+def run_autocorrelograms_time(case):
+    AutocorrelogramsTime(case['select_data'], bin_size=case['bin_size'], start=0,
+                         duration=case['duration'] / 10, shift=case['duration'] / 20, number_of_shift=20)
+
+
+# name: (function, the parameters the kernel depends on)
+KERNELS = {
+    'get_cv2': (run_cv2, ('spikes',)),
+    'calculate_psth': (run_psth, ('spikes', 'trials', 'bin_size')),
+    'JointPeriStimulusTimeHistogram': (run_jpsth, ('spikes', 'trials', 'bin_size')),
+    'Autocorrelograms': (run_autocorrelograms, ('spikes', 'bin_size')),
+    'AutocorrelogramsTime': (run_autocorrelograms_time, ('spikes', 'bin_size')),
+}
+
+
+def make_case(spikes: int, trials: int, bin_size: float, seed: int = 0):
+    r"""
+    Generate two Poisson trains with about the given number of spikes and trials reference events spread
+    over the session.
+    """
+    rng = np.random.default_rng(seed)
+    duration = spikes / FIRING_RATE
+    _, select_data = generate_poisson_trains(rng, FIRING_RATE, duration)
+    _, bottom_data = generate_poisson_trains(rng, FIRING_RATE, duration)
+    reference_data = np.sort(rng.uniform(1, duration - 1, trials))
+    return {'select_data': select_data, 'bottom_data': bottom_data, 'reference_data': reference_data,
+            'duration': duration, 'bin_size': bin_size}
+
+
+def measure(function, case, repeat: int):
+    r"""
+    Returns
+    -------
+    seconds: the best wall time of repeat runs
+    peak_memory: the peak of the memory allocated during one more run, in bytes
+    """
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function(case)
+        seconds.append(time.perf_counter() - start)
+
+    # Run separately, as tracing the allocations slows the kernel down
+    gc.collect()
+    tracemalloc.start()
+    function(case)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(seconds), peak_memory
+
+
+def run_benchmarks(kernels, spikes, trials, bin_sizes, repeat: int = 3):
+    r"""
+    Returns
+    -------
+    records: list of dict with the keys 'kernel', 'spikes', 'trials', 'bin_size', 'seconds' and 'peak_memory'.
+    The parameters a kernel does not depend on are None.
+    """
+    records = []
+    done = set()
+    for spike_number, trial_number, bin_size in itertools.product(spikes, trials, bin_sizes):
+        case = make_case(spike_number, trial_number, bin_size)
+        for name in kernels:
+            function, parameters = KERNELS[name]
+            record = {'kernel': name,
+                      'spikes': spike_number if 'spikes' in parameters else None,
+                      'trials': trial_number if 'trials' in parameters else None,
+                      'bin_size': bin_size if 'bin_size' in parameters else None}
+            key = _record_key(record)
+            if key in done:
+                continue
+            done.add(key)
+            record['seconds'], record['peak_memory'] = measure(function, case, repeat)
+            print(f"{name:32s} spikes={record['spikes']} trials={record['trials']} bin_size={record['bin_size']} "
+                  f"{record['seconds']:.4f} s {record['peak_memory'] / 2 ** 20:.1f} MiB", flush=True)
+            records.append(record)
+    return records
+
+
+def compare_with_baseline(records, baseline_records, tolerance: float = 0.25):
+    r"""
+    Add the keys 'baseline_seconds', 'ratio' and 'regression' to every record found in the baseline.
+
+    Returns
+    -------
+    regressions: the records slower than (1 + tolerance) times their baseline
+    """
+    baseline = {_record_key(record): record for record in baseline_records}
+    regressions = []
+    for record in records:
+        baseline_record = baseline.get(_record_key(record))
+        if baseline_record is None:
+            continue
+        record['baseline_seconds'] = baseline_record['seconds']
+        record['ratio'] = record['seconds'] / baseline_record['seconds']
+        record['regression'] = record['ratio'] > 1 + tolerance
+        if record['regression']:
+            regressions.append(record)
+    return regressions
+
+
+def check_fft_autocorrelograms(spikes: int = 100000, rate: float = 300.0, refractory: float = 0.0025,
+                               oversample: int = 4, seed: int = 0):
+    r"""
+    Compare the FFT autocorrelograms with the pairwise ones on a dense Poisson train, on a dense train with
+    a refractory period and on the recorded Neuron04a. The FFT rounds every distance to a whole sample, which moves
+    a few pairs across every bin edge in both directions: every bin has to stay within a few standard deviations
+    (square roots of its pairwise count) of the pairwise one, and the autocorrelograms of a lag range symmetric
+    around 0 have to be symmetric.
+    The refractory period is not on a bin edge, as the FFT smears a step of the lag density on an edge into the
+    bin below it.
+
+    Returns
+    -------
+    mismatches: list of (train name, x_min, x_max, bin_size) whose autocorrelograms disagree
+    """
+    rng = np.random.default_rng(seed)
+    _, poisson_data = generate_poisson_trains(rng, rate, spikes / rate)
+    _, refractory_data = generate_poisson_trains(rng, rate, spikes * (1 / rate + refractory), 1, refractory)
+    recorded_data = read_from_txt(os.path.join(REPOSITORY, '006-Autocorrelograms', 'Autocorrelograms', 'datas',
+                                               'Neuron04a.txt'))
+    mismatches = []
+    for name, select_data in (('poisson', poisson_data), ('refractory', refractory_data),
+                              ('Neuron04a', recorded_data)):
+        for x_min, x_max, bin_size in ((-0.2, 0.2, 0.005), (-0.5, 0.5, 0.001), (-0.1, 0.3, 0.01)):
+            pairwise = np.asarray(Autocorrelograms(select_data, x_min, x_max, bin_size, method='pairwise').bin_count)
+            fft = get_fft_autocorrelograms(select_data, x_min, x_max, bin_size, oversample)
+            symmetric = x_min != -x_max or np.array_equal(fft, fft[::-1])
+            if not symmetric or np.any(np.abs(fft - pairwise) > 5 * np.sqrt(pairwise) + 1):
+                mismatches.append((name, x_min, x_max, bin_size))
+    return mismatches
+
+
+def _record_key(record):
+    return record['kernel'], record['spikes'], record['trials'], record['bin_size']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the spike analysis kernels')
+    parser.add_argument('--kernels', nargs='+', default=list(KERNELS), choices=list(KERNELS))
+    parser.add_argument('--spikes', nargs='+', type=lambda value: int(float(value)), default=[10000, 100000],
+                        help='number of spikes per train, e.g. 1e4 1e6')
+    parser.add_argument('--trials', nargs='+', type=lambda value: int(float(value)), default=[100, 1000],
+                        help='number of reference events')
+    parser.add_argument('--bin-sizes', nargs='+', type=float, default=[0.01, 0.005])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_report.json', help='machine-readable report')
+    parser.add_argument('--baseline', default=None, help='report of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--save-baseline', default=None, help='also write this run as the new baseline')
+    parser.add_argument('--check-fft', action='store_true',
+                        help='also compare the FFT and the pairwise autocorrelograms')
+    args = parser.parse_args()
+
+    engine_mismatches = check_fft_autocorrelograms() if args.check_fft else []
+    for mismatch in engine_mismatches:
+        print(f'FFT and pairwise autocorrelograms differ: {mismatch[0]} x_min={mismatch[1]} x_max={mismatch[2]} '
+              f'bin_size={mismatch[3]}')
+
+    benchmark_records = run_benchmarks(args.kernels, args.spikes, args.trials, args.bin_sizes, args.repeat)
+    benchmark_regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            benchmark_regressions = compare_with_baseline(benchmark_records, json.load(file)['records'],
+                                                          args.tolerance)
+
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'processor': platform.processor(), 'records': benchmark_records}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    for regression in benchmark_regressions:
+        print(f"Regression: {regression['kernel']} spikes={regression['spikes']} trials={regression['trials']} "
+              f"bin_size={regression['bin_size']} {regression['ratio']:.2f} x baseline")
+    sys.exit(1 if benchmark_regressions or engine_mismatches else 0)